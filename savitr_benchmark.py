@@ -0,0 +1,236 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Micro-benchmarks of protocol hot paths. Not an AppDaemon app.
+#
+# Run: python savitr_benchmark.py --frames frames.bin --baseline benchmark_baseline.json
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+import argparse
+import json
+import os
+import socket
+import sys
+import timeit
+import savitr_codec as codec
+import savitr_recorder as recorder
+import savitr_transport as transport
+from savitr_loadtest import BenchHeater
+from savitr_simulator import HeaterSimulator
+
+# Command setters and their values
+SETTERS = {
+    'set_heating_mode': ['remote'],
+    'set_heating_power': ['66'],
+    'set_air_indoor_temp_min_max': ['5.0', '35.0'],
+    'set_coolant_temp_min_max': ['5.0', '90.0'],
+    'set_air_indoor_temp_setpoint': ['20.0'],
+    'set_coolant_temp_setpoint': ['60.0'],
+    'set_air_indoor_temp_control': ['off'],
+}
+
+
+def read_stream(data):
+    """
+    Frame raw stream (it can start in the middle of a message) into messages, like transports do.
+    Returns: list of bytes
+    """
+
+    frames = []
+    frame_buffer = transport.FrameBuffer()
+
+    # Every chunk completes one message at most, so none is replaced by the next one
+    for i in range(0, len(data), codec.MESSAGE_SIZE):
+        frame_count = frame_buffer.frame_count
+        frame_buffer.feed(data[i:i + codec.MESSAGE_SIZE])
+        if frame_buffer.frame_count != frame_count:
+            frames.append(frame_buffer.frame)
+
+    return frames
+
+
+def read_segment(path):
+    """
+    Read messages of recorder segment (see savitr_recorder.py). They are recorded unpacked, so they are packed again.
+    Returns: list of bytes
+    """
+
+    segment = recorder.FrameSegment(path)
+    try:
+        return [bytes(codec.pack_message(bytearray(segment.message(i)))) for i in range(len(segment))]
+    finally:
+        segment.close()
+
+
+def load_frames(path, count=64):
+    """
+    Load recorded messages: raw stream as received from module (eg. with 'nc host 8558 > frames.bin')
+    or recorder segment (*.frames), or simulate them.
+    Returns: list of bytes
+    """
+
+    if path:
+        if path.endswith(recorder.SEGMENT_SUFFIX):
+            frames = read_segment(path)
+        else:
+            with open(path, 'rb') as f:
+                frames = read_stream(f.read())
+        if not frames:
+            raise Exception("No messages in {}".format(path))
+        return frames
+
+    simulator = HeaterSimulator(seed=0)
+    frames = []
+    for i in range(count):
+        simulator.tick()
+        frames.append(simulator.build_frame())
+
+    return frames
+
+
+def create_device():
+    """
+    Create Savitr Heater with stub Home Assistant, connected to one end of a socket pair. So update_state
+    finds the connection open and measures no reconnect bookkeeping.
+    Returns: device and the other end of its socket
+    """
+
+    device = BenchHeater({'device_name': 'savitr', 'host': '127.0.0.1', 'port': 8558, 'timeout': 1})
+    device.connect = lambda: None
+    device.setup()
+    device.socket, peer = socket.socketpair()
+
+    return device, peer
+
+
+def measure(function, number):
+    """
+    Best time of one call in microseconds.
+    """
+
+    return round(min(timeit.repeat(function, number=number, repeat=5)) / number * 1000000, 3)
+
+
+def run(frames, number):
+    """
+    Run all benchmarks.
+    Returns: dict of name: microseconds per call
+    """
+
+    results = {}
+    frames_count = len(frames)
+    processed = [bytes(codec.unpack_message(bytearray(frame))) for frame in frames]
+    message = bytearray(codec.MESSAGE_SIZE)
+    counter = [0]
+
+    def next_frame():
+        counter[0] = (counter[0] + 1) % frames_count
+        return counter[0]
+
+    # Ingoing: unpacking, decoding, checksum
+    def process_ingoing_message():
+        message[:] = frames[next_frame()]
+        BenchHeater.process_ingoing_message(message)
+
+    def process_outgoing_message():
+        message[:] = processed[next_frame()]
+        BenchHeater.process_outgoing_message(message)
+
+    def decode_message():
+        codec.decode_message(processed[next_frame()])
+
+    def calculate_checksum():
+        BenchHeater.calculate_checksum(processed[next_frame()], codec.CHECKSUM_SIZE)
+
+    results['process_ingoing_message'] = measure(process_ingoing_message, number)
+    results['process_outgoing_message'] = measure(process_outgoing_message, number)
+    results['decode_message'] = measure(decode_message, number)
+    results['calculate_checksum'] = measure(calculate_checksum, number)
+
+    # update_state: decode, diff and publish to stub Home Assistant, no socket I/O
+    device, peer = create_device()
+
+    def read():
+        device.ingoing_message[:] = processed[next_frame()]
+        return True
+
+    device.read = read
+    device.update_state()
+    results['update_state'] = measure(device.update_state, number)
+
+    # Drain of 30 queued messages
+    burst = b''.join(frames[i % frames_count] for i in range(30))
+
+    def empty_input_buffer():
+        peer.sendall(burst)
+        device.empty_input_buffer(device.socket)
+
+    results['empty_input_buffer_30_messages'] = measure(empty_input_buffer, max(1, number // 10))
+
+    # Setters: build message, no socket I/O
+    device.write = lambda: device.process_outgoing_message(device.outgoing_message)
+    for name, values in SETTERS.items():
+        setter = getattr(device, name)
+        results[name] = measure(lambda: setter(*values), number)
+
+    device.socket.close()
+    peer.close()
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results with baseline.
+    Returns: list of regressions
+    """
+
+    regressions = []
+    for name, value in results.items():
+        if name not in baseline:
+            continue
+        if value > baseline[name] * (1 + threshold):
+            regressions.append("{}: {} us, baseline {} us".format(name, value, baseline[name]))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of Savitr protocol hot paths.")
+    parser.add_argument('--frames', help="Recorded raw message stream or recorder segment (*.frames). "
+                                         "Simulated messages by default.")
+    parser.add_argument('--number', type=int, default=2000, help="Calls per measurement.")
+    parser.add_argument('--output', help="Write results to this JSON file.")
+    parser.add_argument('--baseline', help="Baseline JSON file to compare with.")
+    parser.add_argument('--threshold', type=float, default=0.25, help="Allowed slowdown, 0.25 is 25%%.")
+    parser.add_argument('--save-baseline', action='store_true', help="Write results as new baseline.")
+    args = parser.parse_args()
+
+    results = run(load_frames(args.frames), args.number)
+
+    for name, value in results.items():
+        print("{:40} {:>10.3f} us".format(name, value))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Baseline is saved to {}.".format(args.baseline))
+        return
+
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print("Regressions:\n" + "\n".join(regressions), file=sys.stderr)
+            sys.exit(1)
+        print("No regressions against {}.".format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
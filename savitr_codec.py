@@ -0,0 +1,455 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Message codec.
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+import operator
+import struct
+import savitr_dicts as dicts
+
+# Size of ingoing and outgoing messages
+MESSAGE_SIZE = 192
+
+# Payload bytes (64-127) of message and their marker bytes (128-191) for packing of temperatures
+PAYLOAD_START = 64
+MARKERS_START = 128
+PAYLOAD_LENGTH = 64
+
+# Translation tables for packing of temperatures:
+# marker 127 means that 128 was taken away from payload byte, payload byte is packed into 7 bits
+MARKER_TO_HIGH_BIT = bytes(128 if byte == 127 else 0 for byte in range(256))
+BYTE_TO_MARKER = bytes(127 if byte > 127 else 0 for byte in range(256))
+BYTE_TO_LOW_BITS = bytes(byte & 0x7f for byte in range(256))
+
+# Checksum is calculated from 0 to 123 bytes, where it is written is taken from 'checksum' of dicts.PARAMETERS
+CHECKSUM_SIZE = 123
+
+# Weight of every byte in checksum is its index
+CHECKSUM_WEIGHTS = tuple(range(CHECKSUM_SIZE + 1))
+
+# struct format chars by byte length
+STRUCT_INT_FORMATS = {
+    1: 'B',
+    2: 'H',
+    4: 'I',
+}
+
+# struct byte order chars
+STRUCT_BYTE_ORDERS = {
+    'big': '>',
+    'little': '<',
+}
+
+
+def chain_converters(converters):
+    """
+    Chain converters into one function.
+    Returns: function or None
+    """
+
+    if not converters:
+        return None
+    if len(converters) == 1:
+        return converters[0]
+
+    def converter(value, functions=tuple(converters)):
+        for function in functions:
+            value = function(value)
+        return value
+
+    return converter
+
+
+def field_format(param, layout='read'):
+    """
+    struct format of parameter in read or write layout, without byte order.
+    Returns: str
+    """
+
+    byte_start = param[layout]['byte_start']
+    byte_length = param[layout]['byte_finish'] - byte_start + 1
+
+    # Strings are taken as they are
+    if param['type'] == 'string':
+        return '{}s'.format(byte_length)
+
+    # Numbers are unpacked by struct with right signedness
+    int_format = STRUCT_INT_FORMATS[byte_length]
+    if param[layout].get('signed'):
+        int_format = int_format.lower()
+
+    return int_format
+
+
+def compile_parameter(name, param, layout='read'):
+    """
+    Build struct and converter for one parameter to read it from the message.
+    Returns: tuple (name, struct, converter)
+    """
+
+    byte_order = STRUCT_BYTE_ORDERS[param[layout].get('byte_order', 'big')]
+    field_struct = struct.Struct(byte_order + field_format(param, layout))
+
+    # Strings are decoded as they are
+    if param['type'] == 'string':
+        return name, field_struct, bytes.decode
+
+    converters = []
+
+    # Also we need to make some calculations (for ex. divide 10)
+    if param['type'] == 'float':
+        scale = param[layout].get('scale')
+        if scale:
+            converters.append(lambda value, scale=scale: value / scale)
+        else:
+            converters.append(float)
+
+    # Convert some parameters into understandable format
+    if 'dictionary' in param:
+        names = {code: item['name'] for code, item in param['dictionary'].items()}
+        converters.append(names.__getitem__)
+
+    if 'on_value' in param:
+        converters.append(lambda value, on_value=param['on_value']: 'on' if value == on_value else 'off')
+
+    return name, field_struct, chain_converters(converters)
+
+
+def compile_encoder_converter(name, param, layout='read'):
+    """
+    Build converter of readable value into raw value of parameter, inverse of compile_parameter.
+    Commands take whole numbers (eg. '11.0' -> 11) before scaling, as the heater`s app does.
+    Returns: function
+    """
+
+    if param['type'] == 'string':
+        return str.encode
+
+    if 'dictionary' in param:
+        codes = {item['name']: code for code, item in param['dictionary'].items()}
+
+        def converter(value):
+            if value not in codes:
+                raise Exception("Unknown {}: {}.".format(name, value))
+            return codes[value]
+
+        return converter
+
+    if 'on_value' in param:
+        return lambda value, on_value=param['on_value']: on_value if value == 'on' else 0
+
+    scale = param[layout].get('scale', 1)
+    if layout == 'write':
+        return lambda value: int(float(value)) * scale
+
+    return lambda value: int(round(float(value) * scale))
+
+
+def compile_decoder(parameters):
+    """
+    Turn parameters into a fixed layout plan: list of (name, offset, unpack function, converter) tuples.
+    """
+
+    plan = []
+    for name, param in parameters.items():
+        name, field_struct, converter = compile_parameter(name, param)
+        plan.append((name, param['read']['byte_start'], field_struct.unpack_from, converter))
+
+    return tuple(plan)
+
+
+# Compiled once at import
+DECODER = compile_decoder(dicts.PARAMETERS)
+
+
+def decode_message(message, decoder=DECODER):
+    """
+    Decode 192-byte ingoing message into a dict of readable values in a single pass.
+    Returns: dict
+    """
+
+    state = {}
+    for name, offset, unpack_from, converter in decoder:
+        value, = unpack_from(message, offset)
+        if converter is not None:
+            value = converter(value)
+        state[name] = value
+
+    return state
+
+
+def compile_field_masks(parameters):
+    """
+    Bit masks of parameter bytes in a message read as one big endian int, in the same order as decoder plan.
+    Returns: tuple of ints
+    """
+
+    masks = []
+    for name, param in parameters.items():
+        byte_start = param['read']['byte_start']
+        byte_length = param['read']['byte_finish'] - byte_start + 1
+        masks.append(((1 << (8 * byte_length)) - 1) << (8 * (MESSAGE_SIZE - byte_start - byte_length)))
+
+    return tuple(masks)
+
+
+# Compiled once at import
+FIELD_MASKS = compile_field_masks(dicts.PARAMETERS)
+
+
+def decode_changes(message, previous, decoder=DECODER, masks=FIELD_MASKS):
+    """
+    Decode only parameters whose bytes differ from previous 192-byte message (both are unpacked).
+    Returns: dict of changed parameters
+    """
+
+    # One XOR finds all changed bytes
+    diff = int.from_bytes(message, 'big') ^ int.from_bytes(previous, 'big')
+
+    changes = {}
+    if not diff:
+        return changes
+
+    for (name, offset, unpack_from, converter), mask in zip(decoder, masks):
+        if diff & mask:
+            value, = unpack_from(message, offset)
+            if converter is not None:
+                value = converter(value)
+            changes[name] = value
+
+    return changes
+
+
+def unpack_message(message):
+    """
+    Recover temperatures of 192-byte ingoing message in place: add 128 to payload bytes marked with 127.
+    Returns: bytearray
+    """
+
+    payload = int.from_bytes(message[PAYLOAD_START:MARKERS_START], 'big')
+    high_bits = int.from_bytes(message[MARKERS_START:MARKERS_START + PAYLOAD_LENGTH].translate(MARKER_TO_HIGH_BIT), 'big')
+
+    # Same as bytearray does for a byte bigger than 255
+    if payload & high_bits:
+        raise ValueError("byte must be in range(0, 256)")
+
+    message[PAYLOAD_START:MARKERS_START] = (payload | high_bits).to_bytes(PAYLOAD_LENGTH, 'big')
+
+    return message
+
+
+def pack_message(message):
+    """
+    Pack temperatures of 192-byte outgoing message in place: take 128 away from payload bytes and mark them with 127.
+    Returns: bytearray
+    """
+
+    payload = message[PAYLOAD_START:MARKERS_START]
+    message[MARKERS_START:MARKERS_START + PAYLOAD_LENGTH] = payload.translate(BYTE_TO_MARKER)
+    message[PAYLOAD_START:MARKERS_START] = payload.translate(BYTE_TO_LOW_BITS)
+
+    return message
+
+
+def calculate_checksum(message, size=CHECKSUM_SIZE):
+    """
+    Calculate checksum: sum of every byte multiplied by its index, from 0 to size byte.
+    Returns: int
+    """
+
+    weights = CHECKSUM_WEIGHTS if size == CHECKSUM_SIZE else range(size + 1)
+
+    # map() stops at the shortest, so message is not sliced
+    return sum(map(operator.mul, weights, message)) & 0xffffffff
+
+
+def compile_checksum(param, layout):
+    """
+    Build struct for checksum in read (ingoing message) or write (outgoing message) layout.
+    Returns: tuple (offset, struct, mask of checksum bits which fit in)
+    """
+
+    byte_start = param[layout]['byte_start']
+    byte_length = param[layout]['byte_finish'] - byte_start + 1
+    checksum_struct = struct.Struct(STRUCT_BYTE_ORDERS[param[layout]['byte_order']] + STRUCT_INT_FORMATS[byte_length])
+
+    return byte_start, checksum_struct, (1 << (8 * byte_length)) - 1
+
+
+# Compiled once at import
+CHECKSUM_LAYOUTS = {layout: compile_checksum(dicts.PARAMETERS['checksum'], layout) for layout in ['read', 'write']}
+
+
+def add_checksum(message, layout='write'):
+    """
+    Calculate and write checksum into message in place: outgoing message by default,
+    layout 'read' - ingoing message (simulator).
+    Returns: bytearray
+    """
+
+    offset, checksum_struct, mask = CHECKSUM_LAYOUTS[layout]
+    checksum_struct.pack_into(message, offset, calculate_checksum(message) & mask)
+
+    return message
+
+
+def verify_checksum(message, layout='read'):
+    """
+    Check that checksum written in message (after packing is recovered) is right: ingoing message by default,
+    layout 'write' - outgoing message (simulator).
+    Returns: bool
+    """
+
+    offset, checksum_struct, mask = CHECKSUM_LAYOUTS[layout]
+    checksum, = checksum_struct.unpack_from(message, offset)
+
+    return checksum == calculate_checksum(message) & mask
+
+
+def compile_message_template(parameters):
+    """
+    Build empty outgoing message with preamble.
+    Returns: bytes
+    """
+
+    template = bytearray(MESSAGE_SIZE)
+
+    # TODO: check this out
+    template[66] = 0  # 66 - Should write 0 everytime?
+
+    # Write preamble
+    msg_preamble = parameters['msg_preamble']
+    template[msg_preamble['write']['byte_start']:msg_preamble['write']['byte_finish'] + 1] = \
+        str.encode(msg_preamble['default_value'])
+
+    return bytes(template)
+
+
+# Built once at import
+MESSAGE_TEMPLATE = compile_message_template(dicts.PARAMETERS)
+
+
+def compile_encoder(parameters):
+    """
+    Turn read layouts of parameters into encoder plan: list of (name, offset, pack function, converter) tuples.
+    It is an inverse of decoder plan, to build ingoing messages (simulator, tests of push mode).
+    """
+
+    plan = []
+    for name, param in parameters.items():
+
+        # Checksum is calculated for the whole message
+        if name == 'checksum':
+            continue
+
+        name, field_struct, converter = compile_parameter(name, param)
+        plan.append((name, param['read']['byte_start'], field_struct.pack_into,
+                     compile_encoder_converter(name, param)))
+
+    return tuple(plan)
+
+
+# Compiled once at import
+ENCODER = compile_encoder(dicts.PARAMETERS)
+
+
+def encode_message(state, encoder=ENCODER):
+    """
+    Build 192-byte ingoing message with checksum from a dict of readable values (before packing).
+    Returns: bytearray
+    """
+
+    message = bytearray(MESSAGE_SIZE)
+    for name, offset, pack_into, converter in encoder:
+        pack_into(message, offset, converter(state[name]))
+
+    return add_checksum(message, 'read')
+
+
+class CommandEncoder:
+    """
+    Write layout of one command of dicts.CMD: cmd_count, cmd_code and "fields" of command are packed by one
+    struct over bytes from the first to the last of them. Bytes between them are padding (zeros of template).
+    """
+
+    def __init__(self, name, cmd, parameters):
+        self.name = name
+        self.code = cmd['code']
+        self.fields = tuple(cmd.get('fields', []))
+
+        # Arguments of pack() in order of their bytes in message
+        names = ('cmd_count', 'cmd_code') + self.fields
+        layout = sorted(range(len(names)), key=lambda i: parameters[names[i]]['write']['byte_start'])
+
+        byte_order = None
+        struct_format = ''
+        position = self.start = parameters[names[layout[0]]]['write']['byte_start']
+        if self.start <= parameters['msg_preamble']['write']['byte_finish']:
+            raise Exception("Command {} overlaps message preamble.".format(name))
+
+        for i in layout:
+            param = parameters[names[i]]
+            byte_start = param['write']['byte_start']
+            if byte_start < position:
+                raise Exception("Parameter {} of {} overlaps another one.".format(names[i], name))
+
+            # Only one byte order is possible in a struct, single bytes and strings have none
+            field = field_format(param, 'write')
+            if param['type'] != 'string' and struct.calcsize(field) > 1:
+                if byte_order not in [None, param['write']['byte_order']]:
+                    raise Exception("Parameters of {} have different byte orders.".format(name))
+                byte_order = param['write']['byte_order']
+
+            struct_format = struct_format + 'x' * (byte_start - position) + field
+            position = param['write']['byte_finish'] + 1
+
+        self.struct = struct.Struct(STRUCT_BYTE_ORDERS[byte_order or 'big'] + struct_format)
+        self.layout = tuple(layout)
+        self.names = tuple(names[i] for i in layout)
+        self.encoders = tuple(compile_encoder_converter(field, parameters[field], 'write') for field in self.fields)
+        self.decoders = tuple(compile_parameter(field, parameters[field], 'write')[2] for field in self.names)
+
+    def pack(self, message, cmd_count, *values):
+        """
+        Build command message in place: template with preamble, cmd_count, cmd_code, values of fields and checksum.
+        Returns: bytearray
+        """
+
+        if len(values) != len(self.fields):
+            raise Exception("Command {} takes {} values, got {}.".format(self.name, len(self.fields), len(values)))
+
+        arguments = (cmd_count, self.code) + tuple(encode(value) for encode, value in zip(self.encoders, values))
+
+        message[:] = MESSAGE_TEMPLATE
+        self.struct.pack_into(message, self.start, *[arguments[i] for i in self.layout])
+
+        return add_checksum(message)
+
+    def unpack(self, message):
+        """
+        Read cmd_count, cmd_code and values of fields from command message (after unpacking), as the device does.
+        Returns: dict
+        """
+
+        values = {}
+        for name, value, converter in zip(self.names, self.struct.unpack_from(message, self.start), self.decoders):
+            values[name] = converter(value) if converter is not None else value
+
+        return values
+
+
+def compile_commands(commands, parameters):
+    """
+    Build encoders of all commands.
+    Returns: dict of name: CommandEncoder
+    """
+
+    return {name: CommandEncoder(name, cmd, parameters) for name, cmd in commands.items()}
+
+
+# Compiled once at import
+COMMANDS = compile_commands(dicts.CMD, dicts.PARAMETERS)
+COMMAND_CODES = {command.code: command for command in COMMANDS.values()}
@@ -0,0 +1,123 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Command acknowledgement tracking.
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+import threading
+import time
+from concurrent.futures import Future
+
+# Command counter is one byte and wraps after 255
+CMD_COUNT_MODULO = 256
+
+
+class PendingCommand:
+    """
+    Command which was sent and waits for its cmd_count and cmd_code to be echoed by WiFi module.
+    """
+
+    def __init__(self, cmd, value, cmd_count, cmd_code, future, attempt, timeout):
+        self.cmd = cmd
+        self.value = value
+        self.cmd_count = cmd_count
+        self.cmd_code = cmd_code
+        self.future = future
+        self.attempt = attempt
+        self.sent_at = time.monotonic()
+        self.deadline = self.sent_at + timeout
+
+
+class AckTracker:
+    """
+    Matches sent commands with cmd_count and cmd_code echoed in ingoing messages.
+
+    Every command gets a Future which is resolved with round trip time in seconds when the echo arrives.
+    WiFi module echoes the last command only, so an echo also acknowledges older commands sent before it.
+    """
+
+    def __init__(self, timeout=5.0, retries=2):
+        self.timeout = timeout
+        self.retries = retries
+        self.pending = {}
+
+        # Push mode matches echoes in transport thread
+        self.lock = threading.Lock()
+
+    def track(self, cmd, value, cmd_count, cmd_code, future=None, attempt=0):
+        """
+        Start waiting for echo of sent command.
+        Returns: Future
+        """
+
+        if future is None:
+            future = Future()
+
+        with self.lock:
+            self.pending[cmd_count] = PendingCommand(cmd, value, cmd_count, cmd_code, future, attempt, self.timeout)
+
+        return future
+
+    def match(self, cmd_count, cmd_code):
+        """
+        Resolve commands acknowledged by echoed cmd_count and cmd_code.
+        Returns: list of (PendingCommand, round trip time)
+        """
+
+        with self.lock:
+            echoed = self.pending.get(cmd_count)
+            if echoed is None or echoed.cmd_code != cmd_code:
+                return []
+
+            now = time.monotonic()
+            acknowledged = []
+            for count, pending in list(self.pending.items()):
+
+                # Sent before or together with the echoed one (counter can wrap)
+                if (cmd_count - count) % CMD_COUNT_MODULO >= CMD_COUNT_MODULO // 2:
+                    continue
+                if pending.sent_at > echoed.sent_at:
+                    continue
+
+                del self.pending[count]
+                acknowledged.append((pending, now - pending.sent_at))
+
+        for pending, round_trip in acknowledged:
+            if not pending.future.done():
+                pending.future.set_result(round_trip)
+
+        return acknowledged
+
+    def expired(self):
+        """
+        Remove commands which were not acknowledged in time.
+        Returns: list of PendingCommand
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            expired = [pending for pending in self.pending.values() if pending.deadline <= now]
+            for pending in expired:
+                del self.pending[pending.cmd_count]
+
+        return expired
+
+    def last_count(self):
+        """
+        Counter of the last sent command which is not acknowledged yet.
+        Returns: int or None
+        """
+
+        with self.lock:
+            if not self.pending:
+                return None
+            return max(self.pending.values(), key=lambda pending: pending.sent_at).cmd_count
+
+    def can_retry(self, pending):
+        """
+        Check if command can be sent again.
+        """
+
+        return pending.attempt < self.retries
@@ -0,0 +1,1266 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Device logic.
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+import socket
+import time
+import savitr_dicts as dicts
+import savitr_codec as codec
+import savitr_transport as transport
+import savitr_metrics as metrics
+import savitr_commands as commands
+import savitr_scheduler as scheduler
+import savitr_publisher as publisher
+import savitr_hass as hass_client
+import savitr_recorder as recorder
+import savitr_timeseries as timeseries
+import savitr_energy as energy
+
+# Push mode: min interval between updates of these entities, in seconds (fields which change every message)
+PUSH_PUBLISH_INTERVALS = {
+    'clock_seconds': 60,
+}
+
+# Attributes of entity updated by device (changes reason), if entity attributes are not cached yet
+DEVICE_ATTRIBUTES = {'reason': 'device'}
+
+# Bytes of cmd_count and cmd_code echo in ingoing message, only they are read to check acknowledgements
+ACK_OFFSETS = (dicts.PARAMETERS['cmd_count']['read']['byte_start'], dicts.PARAMETERS['cmd_code']['read']['byte_start'])
+
+# Commands of parameters which must be set in pairs: cmd -> (pair cmd, key in pair)
+PAIR_COMMANDS = {
+    'set_air_indoor_temp_min': ('set_air_indoor_temp_min_max', 'min'),
+    'set_air_indoor_temp_max': ('set_air_indoor_temp_min_max', 'max'),
+    'set_coolant_temp_min': ('set_coolant_temp_min_max', 'min'),
+    'set_coolant_temp_max': ('set_coolant_temp_min_max', 'max'),
+}
+
+
+class SavitrDevice:
+    """
+    Savitr Heater device: connection, decoding, entities and commands.
+
+    It does not depend on AppDaemon itself. The class which uses it must provide self.args and
+    AppDaemon API methods: log, entity_exists, get_state, set_state, listen_state, cancel_listen_state,
+    listen_event, run_in, run_every and cancel_timer.
+    """
+
+    def setup(self, state_publisher=None):
+        """
+        Set up device from self.args and connect to it.
+
+        In:
+         - state_publisher - StatePublisher shared with other devices, it is flushed by its owner.
+           By default device has its own one and flushes it after every update.
+        """
+
+        self.device_name = self.args['device_name']
+
+        self.host = self.args['host']
+        self.port = self.args['port']
+        self.timeout = self.args['timeout']
+        self.socket = None
+        self.drain_buffer = bytearray(transport.DRAIN_SIZE)
+
+        # Socket transport: the stream is framed into messages (by preambles) like background transports do,
+        # so a partial or misaligned message is never decoded
+        self.socket_frames = transport.FrameBuffer()
+
+        # Unpacked copy of the latest message for acknowledgements of commands
+        self.ack_message = bytearray(codec.MESSAGE_SIZE)
+
+        # Transport: 'socket' - blocking socket read on every update,
+        # 'thread' - reader thread in background, 'async' - asyncio reader in background
+        self.transport_type = self.args.get('transport', 'socket')
+        if self.transport_type not in ['socket', 'thread', 'async']:
+            raise Exception("Transport must be 'socket', 'thread' or 'async', got {}".format(self.transport_type))
+        self.transport = None
+
+        # Update mode: 'poll' - decode the latest message on timer, 'push' - decode every message when it arrives
+        # (background transports only), changed fields are published not more often than publish_interval
+        self.update_mode = self.args.get('update_mode', 'poll')
+        if self.update_mode not in ['poll', 'push']:
+            raise Exception("Update mode must be 'poll' or 'push', got {}".format(self.update_mode))
+        if self.update_mode == 'push' and self.transport_type == 'socket':
+            raise Exception("Update mode 'push' needs 'thread' or 'async' transport")
+        self.publish_intervals = dict(PUSH_PUBLISH_INTERVALS)
+        for name, value in self.args.get('publish_interval', {}).items():
+            self.publish_intervals[name] = float(value)
+        self.published_at = {}
+        self.deferred = set()
+        self.previous_message = None
+
+        # Connection supervisor: jittered exponential backoff, after circuit_threshold failures in a row
+        # the circuit opens and the device is polled once in circuit_timeout only
+        self.supervisor = transport.ConnectionSupervisor(
+            backoff_max=float(self.args.get('backoff_max', 300)),
+            circuit_threshold=int(self.args.get('circuit_threshold', 5)),
+            circuit_timeout=float(self.args.get('circuit_timeout', 300)))
+        self.unavailable = False
+
+        # Preallocated buffers for messages, they are reused for every message
+        self.ingoing_message = bytearray(codec.MESSAGE_SIZE)
+        self.outgoing_message = bytearray(codec.MESSAGE_SIZE)
+        self.state = {}
+
+        # Drop ingoing messages with wrong checksum
+        self.verify_checksum = bool(self.args.get('verify_checksum', False))
+
+        # Raw message recorder: every valid ingoing message (not more often than record_interval)
+        # is appended to segment files in record_dir right when it is framed, not only polled ones
+        self.recorder = None
+        self.record_message = None
+        if 'record_dir' in self.args:
+            self.recorder = recorder.FrameRecorder(
+                self.args['record_dir'], self.device_name,
+                segment_records=int(self.args.get('record_segment_records', recorder.SEGMENT_RECORDS)),
+                segments_max=int(self.args.get('record_segments', 0)),
+                interval=float(self.args.get('record_interval', 0)))
+            self.record_message = bytearray(codec.MESSAGE_SIZE)
+            self.socket_frames.on_message = self.record_frame
+
+        # Time-series store with 1-minute, 1-hour and 1-day rollups of decoded values
+        self.timeseries = None
+        if 'timeseries_db' in self.args:
+            self.timeseries = timeseries.TimeSeriesStore(
+                self.args['timeseries_db'], self.device_name, fields=self.args.get('timeseries_fields'))
+
+        # Energy and duty cycle accounting, needs rated power of heater in kW
+        self.energy = None
+        self.energy_interval = int(self.args.get('energy_interval', 60))
+
+        # Instrumentation: latency histograms and counters, published as diagnostic sensors
+        self.metrics = metrics.register(self.device_name)
+        self.metrics_interval = int(self.args.get('metrics_interval', 60))
+        self.last_frame_count = 0
+
+        # Command queue: pending commands by cmd (latest value wins), sent not faster than command_interval
+        self.command_queue = {}
+        self.command_interval = float(self.args.get('command_interval', 1.0))
+        self.command_timer = None
+        self.command_sent_at = 0.0
+
+        # Acknowledgements: sent commands wait for cmd_count and cmd_code echo in ingoing messages
+        self.acks = commands.AckTracker(float(self.args.get('ack_timeout', 5.0)), int(self.args.get('ack_retries', 2)))
+        self.ack_timer = None
+        self.sent_cmd_count = None
+        self.sent_cmd_code = None
+
+        # Adaptive polling, see start_polling()
+        self.scheduler = None
+        self.poll_timer = None
+
+        # Last values published to Home Assistant and optional deadbands to skip small changes
+        self.published = {}
+        self.deadband = {}
+        for name, value in self.args.get('deadband', {}).items():
+            if name not in dicts.PARAMETERS or dicts.PARAMETERS[name]['type'] != 'float':
+                raise Exception("Deadband can be set only for float parameters, got {}".format(name))
+            self.deadband[name] = float(value)
+
+        # Batched publishing of entity states: through AppDaemon or right to Home Assistant REST API
+        # over one keep-alive connection shared by all heaters
+        self.own_publisher = state_publisher is None
+        if state_publisher is None:
+            set_state = self.set_state
+            if 'hass_url' in self.args:
+                client = hass_client.get_client(self.args['hass_url'], self.args['hass_token'], log=self.log)
+                set_state = client.set_state
+            state_publisher = publisher.StatePublisher(set_state, log=self.log)
+        self.publisher = state_publisher
+
+        # Entity registry cache: all possible entity_ids, existing entity_ids, their attributes
+        # and listen_state handles
+        self.entity_candidates = {}
+        for name, param in dicts.PARAMETERS.items():
+            if 'hass_entity_type' in param:
+                self.entity_candidates[name] = param['hass_entity_type'] + "." + self.device_name + "_" + name
+        self.entity_candidate_names = {entity_id: name for name, entity_id in self.entity_candidates.items()}
+        self.entities = {}
+        self.entity_names = {}
+        self.entity_attributes = {}
+        self.entity_handles = {}
+
+        # Init methods
+        if self.transport_type == 'async':
+            self.transport = transport.AsyncTransport(self.host, self.port, self.timeout, self.supervisor,
+                                                      log=self.log)
+            if self.update_mode == 'push':
+                self.transport.frames.on_frame = self.on_frame
+            if self.recorder:
+                self.transport.frames.on_message = self.record_frame
+            self.transport.start(transport.shared_loop())
+        elif self.transport_type == 'thread':
+            self.transport = transport.ThreadTransport(self.host, self.port, self.timeout, self.supervisor,
+                                                       log=self.log)
+            if self.update_mode == 'push':
+                self.transport.frames.on_frame = self.on_frame
+            if self.recorder:
+                self.transport.frames.on_message = self.record_frame
+            self.transport.start()
+        else:
+            self.reconnect()
+        self.refresh_entities()
+        self.listen_event(self.entity_registry_callback, "entity_registry_updated")
+        self.listen_event(self.entity_registry_callback, "call_service", service="reload")
+
+        if 'rated_power' in self.args:
+            self.setup_energy(float(self.args['rated_power']))
+        if self.metrics_interval > 0:
+            self.run_every(self.publish_metrics, "now+{}".format(self.metrics_interval), self.metrics_interval)
+        if 'prometheus_port' in self.args:
+            metrics.start_exporter(int(self.args['prometheus_port']), self.args.get('prometheus_host', '127.0.0.1'))
+
+    def setup_energy(self, rated_power):
+        """
+        Start energy meter. Totals continue from states of energy sensors in Home Assistant.
+        """
+
+        totals = []
+        for name in ['energy', 'element_switches']:
+            try:
+                totals.append(float(self.get_state("sensor." + self.device_name + "_" + name)))
+            except (TypeError, ValueError):
+                totals.append(0.0)
+
+        self.energy = energy.EnergyMeter(rated_power, energy=totals[0], switches=int(totals[1]))
+        self.log("Energy meter starts from %s kWh.", totals[0], level="INFO")
+
+        self.run_every(self.publish_energy, "now+{}".format(self.energy_interval), self.energy_interval)
+
+    def shutdown(self):
+        """
+        Close connection to device.
+        """
+
+        if self.transport:
+            self.transport.stop()
+        self.disconnect()
+        if self.recorder:
+            self.recorder.close()
+        if self.timeseries:
+            self.timeseries.close()
+
+    """CONNECTION"""
+
+    def connect(self):
+        """
+        Open connection.
+        """
+
+        self.log("Connecting to %s at %s:%s.", self.device_name, self.host, self.port, level="INFO")
+
+        # Create connection, partial message of the previous one is useless
+        self.socket = socket.create_connection((self.host, self.port), self.timeout)
+        self.socket_frames.clear()
+
+        # Test connection
+        self.test_connection()
+
+    def disconnect(self):
+        """
+        Close connection.
+        """
+
+        self.log("Disconnecting from %s at %s:%s.", self.device_name, self.host, self.port, level="INFO")
+
+        # Delete connection
+        if self.socket:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+
+        self.socket = None
+
+    def reconnect(self):
+        """
+        Open connection if it is closed and it is time to try (one attempt, never sleeps).
+        Returns: True if connected
+        """
+
+        if self.socket:
+            return True
+
+        if not self.supervisor.can_attempt():
+            return False
+
+        if self.supervisor.failures:
+            self.metrics.count('reconnects')
+
+        try:
+            with self.metrics.timer('reconnect'):
+                self.connect()
+        except Exception as e:
+            self.connection_failed(e)
+            return False
+
+        self.connection_succeeded()
+
+        return True
+
+    def test_connection(self):
+        """
+        Test connection.
+        """
+
+        chunk = self.socket.recv(192)  # returns a string
+        if chunk == b'':
+            raise Exception("Connection to device is broken, please check everything.")
+
+        self.log("Connected to %s at %s:%s.", self.device_name, self.host, self.port, level="INFO")
+
+    def connection_failed(self, error):
+        """
+        Close broken connection and schedule the next attempt.
+        """
+
+        self.disconnect()
+
+        delay = self.supervisor.failure()
+        self.log("Can`t communicate with device. Error: %s. Next attempt after %.1f s (%s).",
+                 error, delay, self.supervisor.state, level="ERROR")
+
+        if self.supervisor.state == transport.CIRCUIT_OPEN and not self.unavailable:
+            self.mark_unavailable()
+
+    def connection_succeeded(self):
+        """
+        Connection is fine: close the circuit.
+        """
+
+        if self.supervisor.success():
+            self.log("Connection to %s is restored.", self.device_name, level="INFO")
+        self.unavailable = False
+
+    def connection_available(self):
+        """
+        Check connection state before poll. Background transports reconnect by themselves.
+        Returns: True if device can be polled
+        """
+
+        if not self.transport:
+            return self.reconnect()
+
+        if self.supervisor.state == transport.CIRCUIT_OPEN:
+            if not self.unavailable:
+                self.mark_unavailable()
+            return False
+
+        if self.transport.connected:
+            self.unavailable = False
+
+        return self.transport.connected
+
+    def read(self):
+        """
+        Read and process message from device.
+        Returns: True if a message was read
+        """
+
+        # Background transport already has the latest message - no socket I/O here
+        if self.transport:
+            frame = self.transport.frames.frame
+            if frame is None:
+                self.log("No message from device yet.", level="WARNING")
+                return False
+
+            # Messages which came since last read were never decoded
+            frame_count = self.transport.frames.frame_count
+            if frame_count - self.last_frame_count > 1:
+                self.metrics.count('frames_dropped', frame_count - self.last_frame_count - 1)
+            self.last_frame_count = frame_count
+
+            self.ingoing_message[:] = frame
+            self.process_ingoing_message(self.ingoing_message)
+            return self.check_ingoing_message()
+
+        if not self.reconnect():
+            return False
+
+        try:
+            frames = self.socket_frames
+            frame_count = frames.frame_count
+
+            # Take what is already there (the newest message is kept, older ones are dropped), don't wait
+            self.empty_input_buffer(self.socket, frames)
+
+            # No new message yet - wait for the next one
+            while frames.frame_count == frame_count:
+                chunk_size = self.socket.recv_into(self.drain_buffer)
+                if chunk_size == 0:
+                    raise Exception("Connection to device is broken, please check everything.")
+                frames.feed(memoryview(self.drain_buffer)[:chunk_size])
+
+            if frames.frame_count - frame_count > 1:
+                self.metrics.count('frames_dropped', frames.frame_count - frame_count - 1)
+            self.log("Got a message. Processing ingoing message...", level="INFO")
+
+            # Process it with some magic stuff
+            self.ingoing_message[:] = frames.frame
+            self.process_ingoing_message(self.ingoing_message)
+
+        except Exception as e:
+            self.connection_failed(e)
+            return False
+
+        self.connection_succeeded()
+
+        return self.check_ingoing_message()
+
+    def check_ingoing_message(self):
+        """
+        Verify checksum of ingoing message, if it is enabled.
+        Returns: True if message can be decoded
+        """
+
+        if not self.verify_checksum or codec.verify_checksum(self.ingoing_message):
+            self.metrics.count('frames_received')
+            return True
+
+        self.metrics.count('checksum_failures')
+        self.metrics.count('frames_dropped')
+        self.log("Message with wrong checksum is dropped (%s in total).",
+                 self.metrics.counters['checksum_failures'], level="WARNING")
+
+        return False
+
+    def record_frame(self, frame):
+        """
+        Append message to recorder right when it is framed (in the receiving thread of background transports),
+        so every message is recorded, not only polled ones. Recording problems never break updates.
+        """
+
+        message = self.record_message
+        message[:] = frame
+        self.process_ingoing_message(message)
+        if self.verify_checksum and not codec.verify_checksum(message):
+            return
+
+        try:
+            self.recorder.record(message)
+        except OSError as e:
+            self.log("Can`t record message. Error: %s.", e, level="ERROR")
+
+    def write(self):
+        """
+        Process and write message to device.
+        """
+
+        with self.metrics.timer('write'):
+            self.write_message()
+
+    def write_message(self):
+        """
+        Process and write message to device (not timed).
+        """
+
+        # Process it with some magic stuff
+        self.process_outgoing_message(self.outgoing_message)
+
+        # Background transport reconnects by itself
+        if self.transport:
+            try:
+                bytes_quantity = self.transport.send_threadsafe(self.outgoing_message)
+                self.log("Message of %s bytes was written.", bytes_quantity, level="INFO")
+            except Exception as e:
+                self.log("Can`t write to device. Error: %s.", e, level="ERROR")
+            return
+
+        if not self.reconnect():
+            self.log("Can`t write to device, it is offline.", level="ERROR")
+            return
+
+        try:
+            # Write one message
+            self.log("Writing message.", level="DEBUG")
+            bytes_quantity = self.socket.send(self.outgoing_message)  # Returns the number of bytes sent.
+            self.log("Message of %s bytes was written.", bytes_quantity, level="INFO")
+        except Exception as e:
+            self.connection_failed(e)
+
+    """MAIN"""
+
+    def refresh_entities(self, kwargs=None):
+        """
+        Fill entity registry cache: which entities of this device exist in Home Assistant.
+        """
+
+        entities = {}
+        attributes = {}
+        for name, entity_id in self.entity_candidates.items():
+            if self.entity_exists(entity_id):
+                entities[name] = entity_id
+
+                # Attributes are read once here, not on every update. Add changes reason to them.
+                entity = self.get_state(entity_id, attribute="all") or {}
+                attributes[name] = dict(entity.get("attributes", {}))
+                attributes[name]['reason'] = 'device'
+
+        # New entities must get current values on next update
+        for name in entities.keys() - self.entities.keys():
+            self.published.pop(name, None)
+
+        self.entity_attributes = attributes
+        self.entities = entities
+        self.entity_names = {entity_id: name for name, entity_id in entities.items()}
+
+        self.log("Entity cache is refreshed, %s entities found.", len(entities), level="DEBUG")
+
+        self.subscribe_on_entities()
+
+    def entity_registry_callback(self, event_name, data, kwargs):
+        """
+        Invalidate entity registry cache when Home Assistant creates, removes or reloads entities.
+        """
+
+        # Entity registry event about some other entity - skip
+        if event_name == 'entity_registry_updated':
+            if data.get('action') not in ['create', 'remove']:
+                return
+            if data.get('entity_id') not in self.entity_candidate_names:
+                return
+
+        self.log("Home Assistant entities were changed (%s). Refreshing entity cache.", event_name, level="DEBUG")
+
+        # Give Home Assistant a second to finish
+        self.run_in(self.refresh_entities, 1)
+
+    def subscribe_on_entities(self):
+        """
+        Listen to states of cached entities which can be changed by user.
+        """
+
+        # Cancel callbacks of removed entities
+        for entity_id in list(self.entity_handles):
+            if entity_id not in self.entity_names:
+                self.cancel_listen_state(self.entity_handles.pop(entity_id))
+
+        for name, entity_id in self.entities.items():
+
+            # Check if we need to listen its state
+            if dicts.PARAMETERS[name]['hass_entity_type'] not in ['input_number', 'input_select', 'input_boolean']:
+                continue
+
+            # Already registered - skip
+            if entity_id in self.entity_handles:
+                continue
+
+            # Register callback
+            self.entity_handles[entity_id] = self.listen_state(
+                self.listen_state_callback, entity=entity_id, attribute='all')
+
+            self.log("Callback for entity %s is registered.", entity_id, level="DEBUG")
+
+    def start_polling(self, floor, ceiling):
+        """
+        Poll device with adaptive interval between floor and ceiling, in seconds.
+        """
+
+        self.scheduler = scheduler.PollScheduler(floor, ceiling, int(self.args.get('stable_polls', 3)))
+        self.set_poll_ceiling(ceiling)
+        self.poll_timer = self.run_in(self.poll, 0)
+
+    def set_poll_ceiling(self, ceiling):
+        """
+        Longest interval between updates, in seconds. Energy meter counts intervals up to twice of it,
+        so a heater polled rarely (eg. stable for a long time) is not taken as offline.
+        """
+
+        if self.energy:
+            self.energy.max_gap = max(energy.MAX_GAP, 2 * ceiling)
+
+    def poll(self, kwargs=None):
+        """
+        Update state and schedule the next poll.
+        """
+
+        self.poll_timer = None
+        changes = {}
+        try:
+            changes = self.update_state()
+        finally:
+            interval = self.scheduler.interval
+            self.poll_timer = self.run_in(self.poll, self.scheduler.next_interval(changes))
+
+            if self.scheduler.interval != interval:
+                self.log("Poll interval is %s s now.", self.scheduler.interval, level="DEBUG")
+                self.publisher.add("sensor." + self.device_name + "_diag_poll_interval", self.scheduler.interval,
+                                   {'unit_of_measurement': 's'})
+                if self.own_publisher:
+                    self.publisher.flush()
+
+    def poll_soon(self):
+        """
+        Something was changed from Home Assistant: poll as fast as possible from now on.
+        """
+
+        if self.scheduler is None:
+            return
+
+        self.scheduler.activity()
+        if self.poll_timer is not None:
+            self.cancel_timer(self.poll_timer)
+        self.poll_timer = self.run_in(self.poll, self.scheduler.interval)
+
+    def update_state(self, kwargs=None):
+        """
+        Decode input message and update the status of this Savitr.
+        Returns: dict of fields published to Home Assistant
+        """
+
+        # Offline device is not polled until the next connection attempt
+        if not self.connection_available():
+            return {}
+
+        # Push mode: messages are decoded and published by on_frame, polls only check connection
+        if self.update_mode == 'push':
+            return {}
+
+        # Read from device
+        with self.metrics.timer('read'):
+            if not self.read():
+                return {}
+
+        # Decode the whole message with precompiled decoder (see savitr_codec.py)
+        with self.metrics.timer('decode'):
+            state = codec.decode_message(self.ingoing_message)
+        self.log("Decoded message: %s.", state, level="DEBUG")
+
+        # Updating self.state
+        self.state.update(state)
+        if self.acks.pending:
+            self.resolve_acks(state)
+        if self.timeseries:
+            self.store_state()
+        if self.energy:
+            self.energy.add(time.time(), self.state['heater_status'], self.state['heating_power'])
+
+        # Updating entities which were changed only
+        with self.metrics.timer('publish'):
+            changes = self.changed_fields(state)
+            for name, value in changes.items():
+                self.update_entity(name, value)
+                self.published[name] = value
+            if self.own_publisher:
+                self.publisher.flush()
+
+        return changes
+
+    def on_frame(self, frame):
+        """
+        Push mode: decode message right when it arrives and publish changed fields.
+        Called by background transport, one message at a time.
+        """
+
+        try:
+            with self.metrics.timer('decode'):
+                self.ingoing_message[:] = frame
+                self.process_ingoing_message(self.ingoing_message)
+                if not self.check_ingoing_message():
+                    return
+
+                # Decode only fields whose bytes changed since previous message.
+                # Previous message is kept only after decoding succeeded, so the first full decode is repeated
+                # till it succeeds and no field is missed.
+                if self.previous_message is None:
+                    changes = codec.decode_message(self.ingoing_message)
+                    self.previous_message = bytearray(self.ingoing_message)
+                else:
+                    changes = codec.decode_changes(self.ingoing_message, self.previous_message)
+                    self.previous_message[:] = self.ingoing_message
+
+            self.state.update(changes)
+            if self.acks.pending:
+                self.resolve_acks(self.state)
+            if self.timeseries:
+                self.store_state()
+            if self.energy:
+                self.energy.add(time.time(), self.state['heater_status'], self.state['heating_power'])
+
+            self.publish_changes(changes)
+        except Exception as e:
+            self.log("Can`t process message from device. Error: %s.", e, level="ERROR")
+
+    def publish_changes(self, changes):
+        """
+        Push mode: publish changed fields, but every field not more often than its publish interval.
+        Fields which are held back are published with one of the next messages.
+        """
+
+        now = time.monotonic()
+
+        # Changed fields, held back fields and fields which must be published again (eg. after reconnect)
+        candidates = dict(changes)
+        for name in self.deferred:
+            candidates.setdefault(name, self.state[name])
+        if len(self.published) < len(self.state):
+            for name, value in self.state.items():
+                if name not in self.published:
+                    candidates.setdefault(name, value)
+        self.deferred = set()
+
+        with self.metrics.timer('publish'):
+            for name, value in self.changed_fields(candidates).items():
+                if name in self.published_at and now - self.published_at[name] < self.publish_intervals.get(name, 0):
+                    self.deferred.add(name)
+                    continue
+                self.update_entity(name, value)
+                self.published[name] = value
+                self.published_at[name] = now
+
+            # Messages come at any moment, so they are not waiting for anybody
+            self.publisher.flush()
+
+    def store_state(self):
+        """
+        Add decoded values to time-series store. Storage problems never break updates.
+        """
+
+        try:
+            self.timeseries.add(time.time(), self.state)
+        except Exception as e:
+            self.log("Can`t store values. Error: %s.", e, level="ERROR")
+
+    def changed_fields(self, state):
+        """
+        Compare decoded state with values published to Home Assistant.
+        Returns: dict of changed fields
+        """
+
+        changes = {}
+        for name, value in state.items():
+
+            # Never published - publish
+            if name not in self.published:
+                changes[name] = value
+                continue
+
+            old_value = self.published[name]
+            if value == old_value:
+                continue
+
+            # Skip small changes of noisy values (eg. temperatures)
+            if name in self.deadband and abs(value - old_value) < self.deadband[name]:
+                continue
+
+            changes[name] = value
+
+        self.log("Changed fields: %s.", changes, level="DEBUG")
+
+        return changes
+
+    def update_entity(self, name, value):
+        """
+        Update Home Assistant entity.
+        """
+
+        # If this can`t be entity or it does not exist in Home Assistant - skip
+        entity_id = self.entities.get(name)
+        if entity_id is None:
+            return
+
+        # Queue update, it is sent with all other changes of this message
+        self.publisher.add(entity_id, value, self.entity_attributes.get(name, DEVICE_ATTRIBUTES))
+
+        self.log("Entity %s is updated with %s.", entity_id, value, level="DEBUG")
+
+    def mark_unavailable(self):
+        """
+        Mark all entities of offline device unavailable.
+        """
+
+        self.log("Device %s is offline, its entities are unavailable.", self.device_name, level="WARNING")
+        self.unavailable = True
+
+        for name, entity_id in self.entities.items():
+            self.publisher.add(entity_id, "unavailable", self.entity_attributes.get(name, DEVICE_ATTRIBUTES))
+        self.publisher.flush()
+
+        # Publish everything again when device is back
+        self.published.clear()
+
+    def publish_energy(self, kwargs=None):
+        """
+        Publish energy, element switches and duty cycle sensors.
+        """
+
+        for entity_id, (state, attributes) in self.energy.sensors(self.device_name).items():
+            self.publisher.add(entity_id, state, attributes)
+        self.publisher.flush()
+
+    def publish_metrics(self, kwargs=None):
+        """
+        Publish instrumentation as diagnostic sensors: counters and latency of every timed operation.
+        """
+
+        prefix = "sensor." + self.device_name + "_diag_"
+
+        self.publisher.add(prefix + "frames_received", self.metrics.counters['frames_received'],
+                           dict(self.metrics.counters))
+        self.publisher.add(prefix + "connection", self.supervisor.state, {'failures': self.supervisor.failures})
+
+        for name, summary in self.metrics.summary().items():
+            attributes = dict(summary)
+            attributes['unit_of_measurement'] = 'ms'
+            self.publisher.add(prefix + name + "_latency", summary['p95_ms'], attributes)
+        self.publisher.flush()
+
+    def listen_state_callback(self, entity, attribute, old, new, kwargs):
+        """
+        Listen state callback.
+
+        """
+
+        self.log("We are in setter for %s. Attributes: %s. Old: %s. New: %s. Kwargs: %s",
+                 entity, attribute, old, new, kwargs, level="DEBUG")
+
+        # If we are here because the device had changed something - return
+        if 'reason' in new['attributes']:
+            return
+
+        # Get values (maybe strings, floats, ints)
+        old_value = old['state']
+        new_value = new['state']
+
+        self.log("Setting %s from %s to %s. Creating and sending message.",
+                 entity, old_value, new_value, level="INFO")
+
+        # Construct cmd name
+        param_name = self.entity_names[entity]
+        cmd = 'set_' + param_name
+
+        self.log("Param_name %s. Cmd is %s.", param_name, cmd, level="DEBUG")
+
+        # Forget published value, so the device`s answer is published even if nothing changed
+        self.published.pop(param_name, None)
+
+        # Queue cmd, it will be sent soon
+        self.enqueue_cmd(cmd, new_value)
+
+    def enqueue_cmd(self, cmd, value):
+        """
+        Add cmd to command queue. Pending cmd with the same code gets the latest value.
+        Returns: Future which is resolved with round trip time when device acknowledges cmd
+        """
+
+        # Min and max are sent in one message
+        if cmd in PAIR_COMMANDS:
+            cmd, key = PAIR_COMMANDS[cmd]
+            pair = self.command_queue[cmd][0] if cmd in self.command_queue else {}
+            pair[key] = value
+            value = pair
+
+        if cmd in self.command_queue:
+            self.log("Cmd %s is coalesced, new value is %s.", cmd, value, level="DEBUG")
+            future = self.command_queue[cmd][1]
+        else:
+            future = commands.Future()
+        self.command_queue[cmd] = (value, future)
+
+        # Schedule sending, not earlier than command_interval after the previous cmd
+        if self.command_timer is None:
+            delay = max(0.0, self.command_sent_at + self.command_interval - time.monotonic())
+            self.command_timer = self.run_in(self.process_command_queue, delay)
+
+        return future
+
+    def process_command_queue(self, kwargs=None):
+        """
+        Send the oldest queued cmd and wait for acknowledgement without blocking.
+        """
+
+        self.command_timer = None
+        if not self.command_queue:
+            return
+
+        cmd = next(iter(self.command_queue))
+        value, future = self.command_queue.pop(cmd)
+
+        # Bad value must not block the rest of the queue
+        try:
+            self.send_cmd(cmd, value, future)
+        except Exception as e:
+            self.log("Cmd %s with value %s was not sent. Error: %r.", cmd, value, e, level="ERROR")
+            if not future.done():
+                future.set_exception(e)
+
+        # More commands - send the next one later
+        if self.command_queue:
+            self.command_timer = self.run_in(self.process_command_queue, self.command_interval)
+
+    def send_cmd(self, cmd, value, future, attempt=0):
+        """
+        Execute cmd and track its acknowledgement.
+        """
+
+        self.sent_cmd_count = None
+        self.execute_cmd(cmd, value)
+        self.command_sent_at = time.monotonic()
+
+        # Nothing was sent (cmd is not implemented)
+        if self.sent_cmd_count is None:
+            future.set_result(0.0)
+            return
+
+        self.acks.track(cmd, value, self.sent_cmd_count, self.sent_cmd_code, future, attempt)
+        if self.ack_timer is None:
+            self.ack_timer = self.run_in(self.check_acks, 1)
+
+        # User is interacting, keep the UI responsive
+        self.poll_soon()
+
+    def resolve_acks(self, state):
+        """
+        Resolve commands acknowledged by cmd_count and cmd_code echo in decoded state.
+        """
+
+        self.resolve_echo(state['cmd_count'], state['cmd_code'])
+
+    def resolve_echo(self, cmd_count, cmd_code):
+        """
+        Resolve commands acknowledged by cmd_count and cmd_code echo.
+        """
+
+        for pending, round_trip in self.acks.match(cmd_count, cmd_code):
+            self.metrics.count('commands_acked')
+            self.metrics.histograms['command'].observe(round_trip)
+            self.log("Cmd %s is acknowledged in %.3f s.", pending.cmd, round_trip, level="INFO")
+
+    def check_acks(self, kwargs=None):
+        """
+        Read the latest message for acknowledgements. Retry commands which were not acknowledged in time.
+        """
+
+        self.ack_timer = None
+
+        # Problem with reading must not stop retries
+        try:
+            self.check_echo()
+        except Exception as e:
+            self.log("Can`t check acknowledgements. Error: %r.", e, level="ERROR")
+
+        try:
+            self.retry_expired_acks()
+        finally:
+            # Commands must never stay pending forever
+            if self.acks.pending and self.ack_timer is None:
+                self.ack_timer = self.run_in(self.check_acks, 1)
+
+    def check_echo(self):
+        """
+        Resolve acknowledgements from cmd_count and cmd_code echo of the latest message only.
+        Full updates are left to polling.
+        """
+
+        # Background transports already have the latest message, socket transport reads what is there without waiting
+        if self.transport:
+            frame = self.transport.frames.frame
+        elif self.socket:
+            frame_count = self.socket_frames.frame_count
+            try:
+                self.empty_input_buffer(self.socket, self.socket_frames)
+            except OSError as e:
+                self.connection_failed(e)
+                return
+
+            # Only a message which came since the last read
+            frame = self.socket_frames.frame if self.socket_frames.frame_count != frame_count else None
+        else:
+            return
+
+        if frame is None:
+            return
+
+        # Unpack a copy (cheap bulk operations), decode only the echo
+        self.ack_message[:] = frame
+        try:
+            self.process_ingoing_message(self.ack_message)
+        except ValueError:
+            return
+        if self.verify_checksum and not codec.verify_checksum(self.ack_message):
+            return
+
+        cmd_count = self.ack_message[ACK_OFFSETS[0]]
+        cmd_code = self.ack_message[ACK_OFFSETS[1]]
+
+        # Counter of the next cmd continues from the echo, even before the next poll
+        self.state['cmd_count'] = cmd_count
+        self.state['cmd_code'] = cmd_code
+
+        self.resolve_echo(cmd_count, cmd_code)
+
+    def retry_expired_acks(self):
+        """
+        Retry commands which were not acknowledged in time, fail them after the last attempt.
+        """
+
+        for pending in self.acks.expired():
+            if self.acks.can_retry(pending):
+                self.metrics.count('commands_retried')
+                self.log("Cmd %s is not acknowledged, sending it again.", pending.cmd, level="WARNING")
+                self.send_cmd(pending.cmd, pending.value, pending.future, pending.attempt + 1)
+            else:
+                self.metrics.count('commands_failed')
+                self.log("Cmd %s is not acknowledged by device.", pending.cmd, level="ERROR")
+                pending.future.set_exception(TimeoutError("Cmd {} is not acknowledged".format(pending.cmd)))
+
+                # Show real device state instead of value set by user
+                self.published.clear()
+
+    def execute_cmd(self, cmd, value):
+        """
+        Cmd selector. Single min and max cmds come here as pairs (see PAIR_COMMANDS).
+
+        """
+
+        if cmd == 'set_wifi':
+            self.set_wifi(value)
+        elif cmd == 'set_mail':
+            self.set_mail(value)
+        elif cmd == 'set_heating_mode':
+            self.set_heating_mode(value)
+        elif cmd == 'set_heating_power':
+            self.set_heating_power(value)
+        elif cmd == 'set_air_indoor_temp_min_max':
+            self.set_air_indoor_temp_min_max(value.get('min', self.state['air_indoor_temp_min']),
+                                             value.get('max', self.state['air_indoor_temp_max']))
+        elif cmd == 'set_coolant_temp_min_max':
+            self.set_coolant_temp_min_max(value.get('min', self.state['coolant_temp_min']),
+                                          value.get('max', self.state['coolant_temp_max']))
+        elif cmd == 'set_air_indoor_temp_setpoint':
+            self.set_air_indoor_temp_setpoint(value)
+        elif cmd == 'set_air_indoor_temp_control':
+            self.set_air_indoor_temp_control(value)
+        elif cmd == 'reset_to_defaults':
+            self.reset_to_defaults(value)
+        elif cmd == 'set_coolant_temp_setpoint':
+            self.set_coolant_temp_setpoint(value)
+
+    def next_cmd_count(self):
+        """
+        Get cmd count for the next command.
+        Returns: int
+        """
+
+        # Get current counter (or the last sent one, if it is not echoed yet) and increment it.
+        # The biggest value is 255.
+        value = self.acks.last_count()
+        if value is None:
+            value = self.state['cmd_count']
+        if value == 255:
+            value = 0
+
+        return value + 1
+
+    def send_command(self, cmd, *values):
+        """
+        Build command message with precompiled encoder of its write layout (see savitr_codec.py) and write it.
+
+        In:
+         - cmd - name of command from dicts.CMD
+         - values - values of its fields, eg. '11.0'
+        """
+
+        command = codec.COMMANDS[cmd]
+        cmd_count = self.next_cmd_count()
+
+        # Template, cmd count, cmd code and values in one pack, then checksum
+        command.pack(self.outgoing_message, cmd_count, *values)
+        self.sent_cmd_count = cmd_count
+        self.sent_cmd_code = command.code
+        self.log("Cmd %s was built: count %s, code %s.", cmd, cmd_count, command.code, level="INFO")
+
+        self.write()
+
+    """SETTERS"""
+
+    def set_wifi(self, value):
+        """
+        Set wifi SSID and password.
+
+        In:
+         - value - tuple (ssid, password)
+
+        TODO: get this from input_texts.
+        """
+
+        ssid, password = value
+
+        # Check values
+        if len(ssid) > 15:
+            raise Exception("SSID name must be 15 symbols max, got {}.".format(len(ssid)))
+
+        if len(password) != 8:
+            raise Exception("Password must be exactly 8 symbols, got {}.".format(len(password)))
+
+        self.send_command('set_wifi', ssid, len(ssid), password)
+
+        self.log("SSID was set to %s.", ssid, level="INFO")
+
+    def set_mail(self, value):
+        """
+        Set mail.
+
+        TODO: Implement this.
+        """
+
+        self.log("Mail was set to %s.", value, level="INFO")
+
+    def set_heating_mode(self, value):
+        """
+        Set heating mode.
+
+        In:
+         - value - string
+        """
+
+        self.send_command('set_heating_mode', value)
+
+        self.log("Heating mode was set to %s.", value, level="INFO")
+
+    def set_heating_power(self, value):
+        """
+        Set heating power (heating elements quantity).
+
+        In:
+         - value - string
+           - 33 - 1 element
+           - 66 - 2 elements
+           - 100 - 3 elements
+        """
+
+        self.send_command('set_heating_power', value)
+
+        self.log("Heating power was set to %s.", value, level="INFO")
+
+    def set_air_indoor_temp_min_max(self, value_min, value_max):
+        """
+        Set air indoor minimum and maximum temperature for mail alarms from wifi module.
+        We need to set them both at the same time ¯\_(ツ)_/¯
+
+        In:
+         - value_min - string, eg. '11.0'
+         - value_max - string, eg. '11.0'
+        """
+
+        self.send_command('set_air_indoor_temp_min_max', value_min, value_max)
+
+        self.log("Air indoor temp limits were set to min %s, max %s.", value_min, value_max, level="INFO")
+
+    def set_coolant_temp_min_max(self, value_min, value_max):
+        """
+        Set coolant minimum and maximum temperature for mail alarms from wifi module.
+        We need to set them both at the same time ¯\_(ツ)_/¯
+
+        In:
+         - value_min - string, eg. '11.0'
+         - value_max - string, eg. '11.0'
+        """
+
+        self.send_command('set_coolant_temp_min_max', value_min, value_max)
+
+        self.log("Coolant temp limits were set to min %s, max %s.", value_min, value_max, level="INFO")
+
+    def set_air_indoor_temp_setpoint(self, value):
+        """
+        Set air indoor temperature setpoint.
+
+        In:
+         - value - string, eg. '11.0'
+        """
+
+        self.send_command('set_air_indoor_temp_setpoint', value)
+
+        self.log("Air indoor temp setpoint was set to %s.", value, level="INFO")
+
+    def set_coolant_temp_setpoint(self, value):
+        """
+        Set coolant temperature setpoint.
+
+        In:
+         - value - string, eg. '11.0'
+        """
+
+        self.send_command('set_coolant_temp_setpoint', value)
+
+        self.log("Coolant temp setpoint was set to %s.", value, level="INFO")
+
+    def set_air_indoor_temp_control(self, value):
+        """
+        Set air indoor temperature control on and off.
+
+        In:
+         - value - string, eg. 'on' or 'off'
+        """
+        if value == 'off':
+            # Need to send empty message with cmd_code
+            self.send_command('set_air_indoor_temp_control')
+        elif value == 'on':
+            # Need to set air indoor temp setpoint again ¯\_(ツ)_/¯
+            self.set_air_indoor_temp_setpoint(self.state['air_indoor_temp_setpoint'])
+
+        self.log("Air indoor temperature control was set to %s.", value, level="INFO")
+
+    def reset_to_defaults(self, value):
+        """
+        Reset to defaults.
+
+        TODO: Implement this.
+        """
+
+        self.log("WiFi module was reset to defaults.", level="INFO")
+
+    """HELPERS"""
+
+    def empty_input_buffer(self, sock, frames=None):
+        """
+        Remove the data present on the socket, frame it into frames (FrameBuffer) if it is given.
+        Returns: tuple (bytes discarded, messages discarded)
+        """
+
+        bytes_drained, frames_drained = transport.drain(sock, self.drain_buffer, frames)
+        self.metrics.count('bytes_drained', bytes_drained)
+
+        # Framed messages are counted by their reader
+        if frames is None:
+            self.metrics.count('frames_dropped', frames_drained)
+        self.log("Input buffer is drained: %s bytes, %s messages.", bytes_drained, frames_drained, level="DEBUG")
+
+        return bytes_drained, frames_drained
+
+    @staticmethod
+    def process_ingoing_message(message):
+        """
+        Process 192-byte packet and clean it by WiFi module`s developer rules.
+        Returns: bytearray
+        """
+
+        # 1. Magic cleaning (message[i] & 0xff) is not needed for bytearray.
+        # https://stackoverflow.com/questions/35372700/whats-0xff-for-in-cv2-waitkey1
+
+        # 2. Recover temperatures in a few bulk operations (see savitr_codec.py).
+        return codec.unpack_message(message)
+
+    @staticmethod
+    def process_outgoing_message(message):
+        """
+        Process 192-byte packet and clean it by WiFi module`s developer rules.
+        Returns: bytearray
+        """
+
+        # 1. Magic packing temperatures in a few bulk operations (see savitr_codec.py).
+        return codec.pack_message(message)
+
+    @staticmethod
+    def calculate_checksum(msg, size):
+        """
+        Calculate checksum.
+        """
+
+        return codec.calculate_checksum(msg, size)
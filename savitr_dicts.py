@@ -124,11 +124,14 @@ CLOCK_WEEKDAY = {
     },
 }
 
+# Commands. Parameters in "fields" are written by the command (write layout) in this order,
+# cmd_count and cmd_code are written by every command.
 CMD = {
     "set_wifi": {
         "code": 17,
         "description": "Set WiFi SSID and password for WiFi module to connect."
                        "MainActivity$11",
+        "fields": ["wifi_ssid", "wifi_ssid_length", "wifi_password"],
     },
     "set_mail": {
         "code": 18,
@@ -140,26 +143,31 @@ CMD = {
         "code": 20,
         "description": "Set heater working mode."
                        "MainActivity",
+        "fields": ["heating_mode"],
     },
     "set_heating_power": {
         "code": 21,
         "description": "Set heating power (elements quantity). 1, 2 or 3 heating elements (phases)."
                        "MainActivity$20",
+        "fields": ["heating_power"],
     },
     "set_air_indoor_temp_min_max": {
         "code": 22,
         "description": "Set min and max indoor air temperature for alarms."
                        "MainActivity$14",
+        "fields": ["air_indoor_temp_min", "air_indoor_temp_max"],
     },
     "set_coolant_temp_min_max": {
         "code": 23,
         "description": "Set min and max coolant temperature for alarms."
                        "MainActivity$15",
+        "fields": ["coolant_temp_min", "coolant_temp_max"],
     },
     "set_air_indoor_temp_setpoint": {
         "code": 24,
         "description": "Set target indoor air temperature."
                        "MainActivity$2",
+        "fields": ["air_indoor_temp_setpoint"],
     },
     "reset_to_defaults": {
         "code": 25,
@@ -185,9 +193,17 @@ CMD = {
         "code": 84,
         "description": "Set target coolant temperature."
                        "MainActivity$12",
+        "fields": ["coolant_temp_setpoint"],
     },
 }
 
+# Parameters with read (ingoing message) and write (outgoing message) layouts. Layouts are compiled into
+# struct based decoders and encoders (see savitr_codec.py):
+#  - "scale" - raw value is value * scale (eg. tenths of °C);
+#  - "signed" - raw value is a signed int;
+#  - "dictionary" - raw value is a code of name;
+#  - "on_value" - raw value of 'on', everything else is 'off'.
+# Setpoints are written as whole °C in one byte, so their write layouts are not scaled.
 PARAMETERS = {
 
     "msg_preamble": {
@@ -322,6 +338,7 @@ PARAMETERS = {
             "byte_order": "big",
         },
         "type": "int",
+        "on_value": 85,
         "description": "Current heater power supply state. 85 is OK, others are NOT_OK.",
         "hass_entity_type": "sensor",
     },
@@ -387,6 +404,7 @@ PARAMETERS = {
             "byte_order": "big",
         },
         "type": "int",
+        "on_value": 257,
         "description": "Air indoor temperature control. 0 (00) - off, 257 (11) - on.",
         "hass_entity_type": "input_boolean",
     },
@@ -397,7 +415,8 @@ PARAMETERS = {
             "byte_start": 80,
             "byte_finish": 81,
             "byte_order": "big",
-            "evaluate": "/10",
+            "scale": 10,
+            "signed": True,
         },
         "type": "float",
         "description": "Current coolant temperature in °C.",
@@ -408,7 +427,8 @@ PARAMETERS = {
             "byte_start": 83,
             "byte_finish": 84,
             "byte_order": "big",
-            "evaluate": "/10",
+            "scale": 10,
+            "signed": True,
         },
         "type": "float",
         "description": "Current indoor air temperature in °C.",
@@ -419,7 +439,8 @@ PARAMETERS = {
             "byte_start": 86,
             "byte_finish": 87,
             "byte_order": "big",
-            "evaluate": "/10",
+            "scale": 10,
+            "signed": True,
         },
         "type": "float",
         "description": "Current outdoor air temperature in °C.",
@@ -475,14 +496,13 @@ PARAMETERS = {
             "byte_start": 101,
             "byte_finish": 102,
             "byte_order": "big",
-            "evaluate": "/10",
+            "scale": 10,
         },
         "write": {
             "byte_start": 69,
             "byte_finish": 69,
             "byte_length": 1,
             "byte_order": "big",
-            "evaluate": "*10",
         },
         "type": "float",
         "description": "Current / Target coolant temperature setpoint in °C for 'COOLANT' mode."
@@ -494,14 +514,13 @@ PARAMETERS = {
             "byte_start": 104,
             "byte_finish": 105,
             "byte_order": "big",
-            "evaluate": "/10",
+            "scale": 10,
         },
         "write": {
             "byte_start": 80,
             "byte_finish": 80,
             "byte_length": 1,
             "byte_order": "big",
-            "evaluate": "*10",
         },
         "type": "float",
         "description": "Current / Target indoor air temperature setpoint in °C for 'AIR' mode."
@@ -515,14 +534,14 @@ PARAMETERS = {
             "byte_start": 110,
             "byte_finish": 111,
             "byte_order": "little",
-            "evaluate": "/10",
+            "scale": 10,
         },
         "write": {
             "byte_start": 76,
             "byte_finish": 77,
             "byte_length": 2,
             "byte_order": "little",
-            "evaluate": "*10",
+            "scale": 10,
         },
         "type": "float",
         "description": "Current / Target min coolant temperature in °C."
@@ -534,14 +553,14 @@ PARAMETERS = {
             "byte_start": 112,
             "byte_finish": 113,
             "byte_order": "little",
-            "evaluate": "/10",
+            "scale": 10,
         },
         "write": {
             "byte_start": 78,
             "byte_finish": 79,
             "byte_length": 2,
             "byte_order": "little",
-            "evaluate": "*10",
+            "scale": 10,
         },
         "type": "float",
         "description": "Current / Target max coolant temperature in °C."
@@ -553,14 +572,14 @@ PARAMETERS = {
             "byte_start": 114,
             "byte_finish": 115,
             "byte_order": "little",
-            "evaluate": "/10",
+            "scale": 10,
         },
         "write": {
             "byte_start": 72,
             "byte_finish": 73,
             "byte_length": 2,
             "byte_order": "little",
-            "evaluate": "*10",
+            "scale": 10,
         },
         "type": "float",
         "description": "Current / Target min indoor air temperature in °C."
@@ -572,14 +591,14 @@ PARAMETERS = {
             "byte_start": 116,
             "byte_finish": 117,
             "byte_order": "little",
-            "evaluate": "/10",
+            "scale": 10,
         },
         "write": {
             "byte_start": 74,
             "byte_finish": 75,
             "byte_length": 2,
             "byte_order": "little",
-            "evaluate": "*10",
+            "scale": 10,
         },
         "type": "float",
         "description": "Current / Target max indoor air temperature in °C."
@@ -594,11 +613,12 @@ PARAMETERS = {
             "byte_finish": 125,
             "byte_order": "big",
         },
+        # Outgoing checksum is little endian: the original app always wrote it so and the device accepts it
         "write": {
             "byte_start": 124,
             "byte_finish": 127,
             "byte_length": 4,
-            "byte_order": "big",
+            "byte_order": "little",
         },
         "type": "int",
         "description": "Message checksum. Is calculated from 0 to 123 bytes.",
@@ -0,0 +1,160 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Energy and duty cycle accounting from decoded messages.
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+import time
+
+# Intervals between messages longer than this are not counted (device was offline), in seconds.
+# Devices raise it to twice of their poll interval, see SavitrDevice.set_poll_ceiling
+MAX_GAP = 300.0
+
+# Heater statuses which mean that heating elements are working ('on', 'on_warning_...')
+HEATING_STATUS_PREFIX = 'on'
+
+# Power of one heating element step, in % of rated power
+ELEMENT_STEP = 33
+
+
+class Period:
+    """
+    Running totals of one hour or one day.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.energy = 0.0
+        self.seconds = 0.0
+        self.heating_seconds = 0.0
+        self.switches = 0
+
+    def duty_cycle(self):
+        """
+        Share of time when heater was heating, in %.
+        """
+
+        if not self.seconds:
+            return 0.0
+
+        return round(self.heating_seconds / self.seconds * 100, 1)
+
+    def summary(self):
+        """
+        Returns: dict
+        """
+
+        return {
+            "energy_kwh": round(self.energy, 3),
+            "heating_hours": round(self.heating_seconds / 3600, 3),
+            "hours": round(self.seconds / 3600, 3),
+            "duty_cycle": self.duty_cycle(),
+            "switches": self.switches,
+        }
+
+
+class EnergyMeter:
+    """
+    Integrates heater load over time: energy in kWh, element switches and duty cycle of the current and the last
+    hour and day. Load is rated_power * heating_power % while heater status is 'on...', else 0.
+    Only running totals are kept, history is never scanned.
+    """
+
+    def __init__(self, rated_power, energy=0.0, switches=0, max_gap=MAX_GAP):
+        self.rated_power = rated_power
+        self.max_gap = max_gap
+
+        # Totals since the beginning, they only grow
+        self.energy = energy
+        self.switches = switches
+
+        self.last_timestamp = None
+        self.last_load = 0.0
+        self.last_elements = 0
+
+        self.hour = None
+        self.day = None
+        self.last_hour = None
+        self.last_day = None
+
+    def add(self, timestamp, heater_status, heating_power):
+        """
+        Account state of heater at timestamp. Load since the previous state is counted as the previous load.
+        """
+
+        heating = str(heater_status).startswith(HEATING_STATUS_PREFIX)
+        elements = heating_power // ELEMENT_STEP if heating else 0
+        load = self.rated_power * heating_power / 100 if heating else 0.0
+
+        # Hour and day of local time
+        local = time.localtime(timestamp)
+        hour_key = local[:4]
+        day_key = local[:3]
+        if self.hour is None or self.hour.key != hour_key:
+            self.last_hour = self.hour
+            self.hour = Period(hour_key)
+        if self.day is None or self.day.key != day_key:
+            self.last_day = self.day
+            self.day = Period(day_key)
+
+        if self.last_timestamp is not None:
+            seconds = timestamp - self.last_timestamp
+            if 0 < seconds <= self.max_gap:
+                energy = self.last_load * seconds / 3600
+                heating_seconds = seconds if self.last_load else 0.0
+                for period in [self.hour, self.day]:
+                    period.energy = period.energy + energy
+                    period.seconds = period.seconds + seconds
+                    period.heating_seconds = period.heating_seconds + heating_seconds
+                self.energy = self.energy + energy
+
+            # Every element turned on or off is a switch
+            switches = abs(elements - self.last_elements)
+            if switches:
+                self.switches = self.switches + switches
+                self.hour.switches = self.hour.switches + switches
+                self.day.switches = self.day.switches + switches
+
+        self.last_timestamp = timestamp
+        self.last_load = load
+        self.last_elements = elements
+
+    def sensors(self, device_name):
+        """
+        Home Assistant sensors. Energy is compatible with energy dashboard (total_increasing kWh).
+        Returns: dict of entity_id: (state, attributes)
+        """
+
+        prefix = "sensor." + device_name + "_"
+        hour = self.hour or Period(None)
+        day = self.day or Period(None)
+
+        return {
+            prefix + "energy": (round(self.energy, 3), {
+                "device_class": "energy",
+                "state_class": "total_increasing",
+                "unit_of_measurement": "kWh",
+                "rated_power_kw": self.rated_power,
+                "reason": "device",
+            }),
+            prefix + "element_switches": (self.switches, {
+                "state_class": "total_increasing",
+                "reason": "device",
+            }),
+            prefix + "duty_cycle_hour": (hour.duty_cycle(), {
+                "state_class": "measurement",
+                "unit_of_measurement": "%",
+                "current": hour.summary(),
+                "last": self.last_hour.summary() if self.last_hour else None,
+                "reason": "device",
+            }),
+            prefix + "duty_cycle_day": (day.duty_cycle(), {
+                "state_class": "measurement",
+                "unit_of_measurement": "%",
+                "current": day.summary(),
+                "last": self.last_day.summary() if self.last_day else None,
+                "reason": "device",
+            }),
+        }
@@ -0,0 +1,240 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Direct writes of entity states to Home Assistant REST API over one persistent connection.
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+import asyncio
+import json
+import threading
+from urllib.parse import quote, urlsplit
+import savitr_transport as transport
+
+# Max requests written to connection before reading their responses
+PIPELINE_SIZE = 64
+
+# Max entities waiting to be written, set_state waits for free space when it is reached
+QUEUE_SIZE = 4096
+
+# Clients by (url, token), shared by all heaters of all apps in this process
+CLIENTS = {}
+_clients_lock = threading.Lock()
+
+
+class HassClient:
+    """
+    Keep-alive HTTP/1.1 connection to Home Assistant REST API (POST /api/states/<entity_id>).
+
+    Writes are queued by entity (the latest state wins) and a writer task on shared_loop() sends them in pipeline:
+    up to PIPELINE_SIZE requests are written at once, then their responses are read in order. If Home Assistant
+    does not keep up, the queue grows up to QUEUE_SIZE entities and then set_state waits (backpressure).
+
+    Home Assistant websocket API has no command to write a state, so REST API is used.
+    """
+
+    def __init__(self, url, token, timeout=10, log=None):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.ssl = parts.scheme == 'https'
+        self.path = parts.path.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+        self.log = log or (lambda *args, **kwargs: None)
+
+        self.supervisor = transport.ConnectionSupervisor(backoff_max=60)
+        self.reader = None
+        self.writer = None
+
+        # Queue of states by entity_id
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.waiting = False
+
+        # Event of writer task is created on the loop by run()
+        self.loop = transport.shared_loop()
+        self.wakeup = None
+        self.task = asyncio.run_coroutine_threadsafe(self.run(), self.loop)
+
+        self.requests = 0
+        self.errors = 0
+
+    def set_state(self, entity_id, state=None, attributes=None, **kwargs):
+        """
+        Queue state of entity, it is written by writer task. Same signature as AppDaemon`s set_state.
+        """
+
+        with self.condition:
+            # Backpressure: wait till writer task takes something from the full queue
+            if entity_id not in self.pending and len(self.pending) >= QUEUE_SIZE:
+                self.condition.wait_for(lambda: len(self.pending) < QUEUE_SIZE, self.timeout)
+
+            self.pending[entity_id] = (state, attributes)
+
+            # Wake up writer task only if it sleeps
+            if self.waiting:
+                return
+            self.waiting = True
+
+        self.loop.call_soon_threadsafe(self.wake)
+
+    def wake(self):
+        """
+        Wake up writer task (on the loop). Before the task starts there is nothing to wake up, it checks the queue.
+        """
+
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def take_batch(self):
+        """
+        Take up to PIPELINE_SIZE queued states.
+        Returns: list of (entity_id, state, attributes)
+        """
+
+        with self.condition:
+            batch = []
+            for entity_id in list(self.pending)[:PIPELINE_SIZE]:
+                state, attributes = self.pending.pop(entity_id)
+                batch.append((entity_id, state, attributes))
+            if not self.pending:
+                self.waiting = False
+            self.condition.notify_all()
+
+        return batch
+
+    def requeue(self, batch):
+        """
+        Return unsent states to queue, unless there are newer ones.
+        """
+
+        with self.condition:
+            for entity_id, state, attributes in batch:
+                self.pending.setdefault(entity_id, (state, attributes))
+
+    def build_request(self, entity_id, state, attributes):
+        """
+        Build HTTP request to write state.
+        Returns: bytes
+        """
+
+        body = json.dumps({"state": state, "attributes": attributes or {}}).encode()
+        head = ("POST {}/api/states/{} HTTP/1.1\r\n"
+                "Host: {}:{}\r\n"
+                "Authorization: Bearer {}\r\n"
+                "Content-Type: application/json\r\n"
+                "Content-Length: {}\r\n"
+                "Connection: keep-alive\r\n"
+                "\r\n").format(self.path, quote(entity_id), self.host, self.port, self.token, len(body))
+
+        return head.encode() + body
+
+    async def read_response(self):
+        """
+        Read one HTTP response.
+        Returns: status code
+        """
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise EOFError("Connection is closed by Home Assistant")
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in [b'\r\n', b'\n', b'']:
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        # Body is not needed, but it must be read to get to the next response
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        else:
+            await self.reader.readexactly(int(headers.get('content-length', 0)))
+
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+
+        return status
+
+    def close(self):
+        """
+        Close connection.
+        """
+
+        if self.writer:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    async def run(self):
+        """
+        Writer task: write queued states in pipeline, reconnect with backoff.
+        """
+
+        self.wakeup = asyncio.Event()
+        with self.condition:
+            if self.pending:
+                self.wakeup.set()
+
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+
+            while True:
+                batch = self.take_batch()
+                if not batch:
+                    break
+
+                try:
+                    if self.writer is None:
+                        self.reader, self.writer = await asyncio.wait_for(
+                            asyncio.open_connection(self.host, self.port, ssl=self.ssl or None), self.timeout)
+
+                    for entity_id, state, attributes in batch:
+                        self.writer.write(self.build_request(entity_id, state, attributes))
+                    await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+                    for i, (entity_id, state, attributes) in enumerate(batch):
+                        status = await asyncio.wait_for(self.read_response(), self.timeout)
+                        self.requests = self.requests + 1
+                        if status >= 300:
+                            self.errors = self.errors + 1
+                            self.log("Home Assistant can`t update %s: HTTP %s.", entity_id, status, level="ERROR")
+
+                        # Connection was closed by server, the rest must be sent again
+                        if self.writer is None:
+                            self.requeue(batch[i + 1:])
+                            break
+
+                    self.supervisor.success()
+
+                except (OSError, EOFError, ValueError, IndexError, asyncio.TimeoutError,
+                        asyncio.IncompleteReadError) as e:
+                    self.close()
+                    self.requeue(batch)
+                    delay = self.supervisor.failure()
+                    self.log("Can`t write to Home Assistant at %s:%s. Error: %r. Next attempt after %.1f s.",
+                             self.host, self.port, e, delay, level="ERROR")
+                    await asyncio.sleep(delay)
+
+
+def get_client(url, token, timeout=10, log=None):
+    """
+    Get client of Home Assistant, one per url and token in this process.
+    Returns: HassClient
+    """
+
+    with _clients_lock:
+        if (url, token) not in CLIENTS:
+            CLIENTS[(url, token)] = HassClient(url, token, timeout, log)
+
+        return CLIENTS[(url, token)]
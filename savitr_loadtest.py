@@ -0,0 +1,271 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Load and latency benchmark against simulated WiFi modules. Not an AppDaemon app.
+#
+# Run: python savitr_loadtest.py --devices 200 --transport async --seconds 30
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+import argparse
+import collections
+import json
+import os
+import subprocess
+import sys
+import time
+import savitr_hass as hass_client
+from savitr_device import SavitrDevice
+
+
+class FakeHass:
+    """
+    Lightweight stand-in of AppDaemon hass.Hass API: keeps states in a dict, all entities exist.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.states = {}
+        self.set_state_count = 0
+
+    def log(self, msg, *args, **kwargs):
+        if kwargs.get('level') in ['ERROR', 'WARNING']:
+            print(msg % args, file=sys.stderr)
+
+    def entity_exists(self, entity_id):
+        return True
+
+    def get_state(self, entity_id=None, attribute=None, **kwargs):
+        return self.states.get(entity_id, {"state": None, "attributes": {}})
+
+    def set_state(self, entity_id, state=None, attributes=None, **kwargs):
+        self.set_state_count = self.set_state_count + 1
+        self.states[entity_id] = {"state": state, "attributes": attributes or {}}
+
+    def listen_state(self, callback, entity=None, **kwargs):
+        return entity
+
+    def cancel_listen_state(self, handle):
+        pass
+
+    def listen_event(self, callback, event=None, **kwargs):
+        return event
+
+    def run_in(self, callback, delay, **kwargs):
+        return None
+
+    def run_every(self, callback, start, interval, **kwargs):
+        return None
+
+    def cancel_timer(self, handle):
+        pass
+
+
+class BenchHeater(SavitrDevice, FakeHass):
+    """
+    Savitr Heater without AppDaemon.
+    """
+
+
+def percentiles(values):
+    """
+    Summary of latencies in milliseconds.
+    Returns: dict
+    """
+
+    if not values:
+        return {}
+
+    values = sorted(values)
+
+    def percentile(p):
+        return round(values[min(len(values) - 1, int(len(values) * p))] * 1000, 3)
+
+    return {
+        "count": len(values),
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(values[-1] * 1000, 3),
+    }
+
+
+def next_cmd_count(cmd_count):
+    """
+    Command counter which the device will echo, see SavitrDevice.next_cmd_count.
+    """
+
+    if cmd_count == 255:
+        cmd_count = 0
+
+    return cmd_count + 1
+
+
+def poll(device, errors):
+    """
+    Update state of device. Errors (eg. of injected faults) are counted in errors (Counter), not raised.
+    Returns: True if state was updated without errors
+    """
+
+    try:
+        device.update_state()
+    except Exception as e:
+        errors[type(e).__name__] += 1
+        return False
+
+    return True
+
+
+def wait_for_ack(device, cmd_count, timeout, errors):
+    """
+    Poll device until it echoes command counter.
+    Returns: True if it was echoed
+    """
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if device.transport:
+            device.transport.frames.wait_next_frame(deadline - time.monotonic())
+        elif not device.supervisor.can_attempt():
+            # Socket transport does nothing while it is backing off - wait for the next attempt, don't spin
+            time.sleep(max(0.0, min(device.supervisor.retry_at, deadline) - time.monotonic()))
+            continue
+        poll(device, errors)
+        if device.state.get('cmd_count') == cmd_count:
+            return True
+
+    return False
+
+
+def start_simulators(args):
+    """
+    Start simulators in another process, so their CPU is not counted.
+    Returns: process and list of ports
+    """
+
+    simulator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'savitr_simulator.py')
+    command = [sys.executable, simulator, '--port', '0', '--devices', str(args.devices), '--rate', str(args.rate),
+               '--lag', str(args.lag), '--partial', str(args.partial), '--disconnect', str(args.disconnect)]
+    if args.hass:
+        command.append('--hass')
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    ports = [int(process.stdout.readline()) for i in range(args.devices)]
+
+    # Home Assistant stand-in
+    hass_port = int(process.stdout.readline()) if args.hass else None
+
+    return process, ports, hass_port
+
+
+def run(args):
+    """
+    Drive devices against simulators and collect measurements.
+    Returns: dict
+    """
+
+    process, ports, hass_port = start_simulators(args)
+
+    try:
+        devices = []
+        for i, port in enumerate(ports):
+            device_args = {
+                'device_name': 'savitr_{}'.format(i),
+                'host': '127.0.0.1',
+                'port': port,
+                'timeout': args.timeout,
+                'transport': args.transport,
+            }
+            if hass_port:
+                device_args['hass_url'] = 'http://127.0.0.1:{}'.format(hass_port)
+                device_args['hass_token'] = 'test'
+            device = BenchHeater(device_args)
+            device.setup()
+            devices.append(device)
+
+        # Let background readers get first messages
+        time.sleep(2 / args.rate)
+
+        poll_latencies = []
+        command_latencies = []
+        commands_lost = 0
+        poll_errors = collections.Counter()
+        frames = 0
+        powers = [33, 66, 100]
+
+        cpu_start = time.process_time()
+        deadline = time.monotonic() + args.seconds
+        round_number = 0
+
+        while time.monotonic() < deadline:
+            round_start = time.monotonic()
+
+            for device in devices:
+                start = time.perf_counter()
+                poll(device, poll_errors)
+                poll_latencies.append(time.perf_counter() - start)
+                frames = frames + 1
+
+            # Command round trip for a part of devices
+            for device in devices[round_number % args.command_every::args.command_every]:
+                if 'cmd_count' not in device.state:
+                    continue
+                cmd_count = next_cmd_count(device.state['cmd_count'])
+                start = time.perf_counter()
+                device.set_heating_power(powers[round_number % len(powers)])
+                if wait_for_ack(device, cmd_count, args.timeout, poll_errors):
+                    command_latencies.append(time.perf_counter() - start)
+                else:
+                    commands_lost = commands_lost + 1
+
+            round_number = round_number + 1
+            time.sleep(max(0.0, args.interval - (time.monotonic() - round_start)))
+
+        cpu = time.process_time() - cpu_start
+
+        for device in devices:
+            device.shutdown()
+    finally:
+        process.terminate()
+        process.wait()
+
+    return {
+        "devices": args.devices,
+        "transport": args.transport,
+        "rounds": round_number,
+        "poll_latency": percentiles(poll_latencies),
+        "command_round_trip": percentiles(command_latencies),
+        "commands_lost": commands_lost,
+        "poll_errors": dict(poll_errors),
+        "cpu_per_frame_us": round(cpu / max(frames, 1) * 1000000, 1),
+        "set_state_calls": sum(device.set_state_count for device in devices),
+        "rest_requests": sum(client.requests for client in hass_client.CLIENTS.values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load and latency benchmark of Savitr Heater against simulators.")
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--transport', default='async', choices=['socket', 'thread', 'async'])
+    parser.add_argument('--seconds', type=float, default=30.0)
+    parser.add_argument('--interval', type=float, default=5.0, help="Seconds between poll rounds.")
+    parser.add_argument('--command-every', type=int, default=10, help="Send a command to every N-th device.")
+    parser.add_argument('--timeout', type=float, default=5.0)
+    parser.add_argument('--rate', type=float, default=1.0, help="Messages per second of simulators.")
+    parser.add_argument('--lag', type=float, default=0.0)
+    parser.add_argument('--partial', type=float, default=0.0)
+    parser.add_argument('--disconnect', type=float, default=0.0)
+    parser.add_argument('--hass', action='store_true', help="Write states to Home Assistant stand-in over REST API.")
+    parser.add_argument('--json', help="Write results to this file.")
+    args = parser.parse_args()
+
+    results = run(args)
+    print(json.dumps(results, indent=2))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Manager of many heaters.
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+import appdaemon.plugins.hass.hassapi as hass
+from savitr_device import SavitrDevice
+from savitr_publisher import StatePublisher
+from savitr_hass import get_client
+
+# Arguments of manager which are default arguments of every device
+DEVICE_DEFAULT_ARGS = ['port', 'timeout', 'transport', 'verify_checksum', 'deadband', 'metrics_interval',
+                       'prometheus_port', 'prometheus_host', 'command_interval', 'ack_timeout', 'ack_retries',
+                       'backoff_max', 'circuit_threshold', 'circuit_timeout', 'update_mode', 'publish_interval',
+                       'record_dir', 'record_interval', 'record_segments', 'record_segment_records', 'timeseries_db',
+                       'timeseries_fields', 'energy_interval']
+
+
+class ManagedHeater(SavitrDevice):
+    """
+    Savitr Heater driven by SavitrManager. AppDaemon API calls go through the manager app.
+    """
+
+    def __init__(self, app, args):
+        self.app = app
+        self.args = args
+
+    def log(self, msg, *args, **kwargs):
+        self.app.log("[" + self.args['device_name'] + "] " + msg, *args, **kwargs)
+
+    def entity_exists(self, *args, **kwargs):
+        return self.app.entity_exists(*args, **kwargs)
+
+    def get_state(self, *args, **kwargs):
+        return self.app.get_state(*args, **kwargs)
+
+    def set_state(self, *args, **kwargs):
+        return self.app.set_state(*args, **kwargs)
+
+    def listen_state(self, *args, **kwargs):
+        return self.app.listen_state(*args, **kwargs)
+
+    def cancel_listen_state(self, *args, **kwargs):
+        return self.app.cancel_listen_state(*args, **kwargs)
+
+    def listen_event(self, *args, **kwargs):
+        return self.app.listen_event(*args, **kwargs)
+
+    def run_in(self, *args, **kwargs):
+        return self.app.run_in(*args, **kwargs)
+
+    def run_every(self, *args, **kwargs):
+        return self.app.run_every(*args, **kwargs)
+
+    def cancel_timer(self, *args, **kwargs):
+        return self.app.cancel_timer(*args, **kwargs)
+
+
+class SavitrManager(hass.Hass):
+    """
+    Savitr Heaters manager.
+
+    One app for many heaters: all connections are served by one asyncio event loop and polls are staggered,
+    so heaters are not polled all at the same tick.
+    """
+
+    def initialize(self):
+        """
+        Start app.
+        """
+
+        self.log("Initializing Savitr Manager instance.", level="INFO")
+
+        self.update_interval = int(self.args["update_interval"])
+        if self.update_interval < 5:
+            raise Exception("Update interval ({}) must be at least 5 second".format(self.update_interval))
+
+        # Entity updates of all devices polled at one tick are sent in one pass,
+        # through AppDaemon or right to Home Assistant REST API
+        set_state = self.set_state
+        if 'hass_url' in self.args:
+            set_state = get_client(self.args['hass_url'], self.args['hass_token'], log=self.log).set_state
+        self.publisher = StatePublisher(set_state, log=self.log)
+
+        # Create devices, by default all of them use async transport with one shared event loop
+        self.devices = []
+        for device_args in self.args['devices']:
+            args = {'transport': 'async'}
+            for name in DEVICE_DEFAULT_ARGS:
+                if name in self.args:
+                    args[name] = self.args[name]
+            args.update(device_args)
+
+            device = ManagedHeater(self, args)
+            device.setup(self.publisher)
+            device.set_poll_ceiling(self.update_interval)
+            self.devices.append(device)
+
+        if not self.devices:
+            raise Exception("At least one device must be set")
+
+        # Split devices into groups, one group is polled per tick (at least 1 second)
+        self.slots = min(len(self.devices), self.update_interval)
+        self.groups = [self.devices[i::self.slots] for i in range(self.slots)]
+        self.slot = 0
+
+        self.run_every(self.update_state, "now", self.update_interval / self.slots)
+
+        self.log("Successfully created Savitr Manager instance with %s devices in %s groups.",
+                 len(self.devices), self.slots, level="INFO")
+
+    def terminate(self):
+        """
+        Terminate app.
+        """
+
+        self.log("Terminating Savitr Manager instance.", level="INFO")
+        for device in self.devices:
+            device.shutdown()
+
+    def update_state(self, kwargs=None):
+        """
+        Update next group of devices.
+        """
+
+        group = self.groups[self.slot]
+        self.slot = (self.slot + 1) % self.slots
+
+        for device in group:
+            try:
+                device.update_state()
+            except Exception as e:
+                self.log("Can`t update %s. Error: %s.", device.device_name, e, level="ERROR")
+
+        self.publisher.flush()
@@ -0,0 +1,205 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Hot path instrumentation: latency histograms, counters and Prometheus exposition.
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of histogram buckets, in seconds
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, float('inf'))
+
+# Timed operations and counters of every device
+TIMERS = ['read', 'decode', 'publish', 'write', 'reconnect', 'command']
+COUNTERS = ['frames_received', 'frames_dropped', 'bytes_drained', 'checksum_failures', 'reconnects',
+            'commands_acked', 'commands_retried', 'commands_failed']
+
+# Metrics of all devices of all apps in this process, by device name
+REGISTRY = {}
+_registry_lock = threading.Lock()
+
+# Prometheus exporters by port
+_exporters = {}
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """
+        Add one measurement in seconds.
+        """
+
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] = self.buckets[i] + 1
+                break
+
+        self.count = self.count + 1
+        self.sum = self.sum + value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket where percentile p (0-1) is.
+        Returns: seconds
+        """
+
+        if not self.count:
+            return 0.0
+
+        rank = p * self.count
+        total = 0
+        for i, bucket in enumerate(self.buckets):
+            total = total + bucket
+            if total >= rank:
+                return min(BUCKETS[i], self.max)
+
+        return self.max
+
+
+class DeviceMetrics:
+    """
+    Latency histograms and counters of one device.
+    """
+
+    def __init__(self, device_name):
+        self.device_name = device_name
+        self.histograms = {name: Histogram() for name in TIMERS}
+        self.counters = {name: 0 for name in COUNTERS}
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Measure time of a block into histogram.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histograms[name].observe(time.perf_counter() - start)
+
+    def count(self, name, value=1):
+        """
+        Increment counter.
+        """
+
+        self.counters[name] = self.counters[name] + value
+
+    def summary(self):
+        """
+        Summary of histograms in milliseconds.
+        Returns: dict of dicts
+        """
+
+        summary = {}
+        for name, histogram in self.histograms.items():
+            summary[name] = {
+                "count": histogram.count,
+                "mean_ms": round(histogram.sum / histogram.count * 1000, 3) if histogram.count else 0.0,
+                "p50_ms": round(histogram.percentile(0.50) * 1000, 3),
+                "p95_ms": round(histogram.percentile(0.95) * 1000, 3),
+                "max_ms": round(histogram.max * 1000, 3),
+            }
+
+        return summary
+
+
+def register(device_name):
+    """
+    Create metrics of device and add them to registry.
+    Returns: DeviceMetrics
+    """
+
+    metrics = DeviceMetrics(device_name)
+    with _registry_lock:
+        REGISTRY[device_name] = metrics
+
+    return metrics
+
+
+def render_prometheus():
+    """
+    Render metrics of all devices in Prometheus text exposition format.
+    Returns: str
+    """
+
+    lines = []
+
+    with _registry_lock:
+        devices = list(REGISTRY.values())
+
+    for name in COUNTERS:
+        lines.append("# TYPE savitr_{}_total counter".format(name))
+        for metrics in devices:
+            lines.append('savitr_{}_total{{device="{}"}} {}'.format(name, metrics.device_name, metrics.counters[name]))
+
+    for name in TIMERS:
+        lines.append("# TYPE savitr_{}_seconds histogram".format(name))
+        for metrics in devices:
+            histogram = metrics.histograms[name]
+            total = 0
+            for bound, bucket in zip(BUCKETS, histogram.buckets):
+                total = total + bucket
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('savitr_{}_seconds_bucket{{device="{}",le="{}"}} {}'.format(
+                    name, metrics.device_name, le, total))
+            lines.append('savitr_{}_seconds_sum{{device="{}"}} {}'.format(name, metrics.device_name, histogram.sum))
+            lines.append('savitr_{}_seconds_count{{device="{}"}} {}'.format(
+                name, metrics.device_name, histogram.count))
+
+    return "\n".join(lines) + "\n"
+
+
+class PrometheusHandler(BaseHTTPRequestHandler):
+    """
+    Serve /metrics.
+    """
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_exporter(port, host='127.0.0.1'):
+    """
+    Start Prometheus exporter on local port in a background thread, once per port.
+    Metrics are not authenticated, so only localhost can read them by default.
+    Returns: ThreadingHTTPServer
+    """
+
+    with _registry_lock:
+        if port not in _exporters:
+            server = ThreadingHTTPServer((host, port), PrometheusHandler)
+            server.daemon_threads = True
+            thread = threading.Thread(target=server.serve_forever, name="savitr-metrics", daemon=True)
+            thread.start()
+            _exporters[port] = server
+
+        return _exporters[port]
@@ -0,0 +1,60 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Batched publishing of entity states to Home Assistant.
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+import threading
+
+
+class StatePublisher:
+    """
+    Gathers entity updates and sends them in one pass.
+
+    Updates of one decoded message (or of all heaters polled at one tick) are added with add() and sent by
+    flush(). If an entity is updated twice before flush, only the latest state is sent.
+    Sending is done by set_state(entity_id, state=..., attributes=...), eg. AppDaemon`s set_state.
+    """
+
+    def __init__(self, set_state, log=None):
+        self.set_state = set_state
+        self.log = log or (lambda *args, **kwargs: None)
+
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        self.flushes = 0
+        self.sent = 0
+
+    def add(self, entity_id, state, attributes):
+        """
+        Queue entity update till flush.
+        """
+
+        with self.lock:
+            self.pending[entity_id] = (state, attributes)
+
+    def flush(self):
+        """
+        Send all queued updates.
+        Returns: number of updated entities
+        """
+
+        with self.lock:
+            if not self.pending:
+                return 0
+            pending = self.pending
+            self.pending = {}
+
+        for entity_id, (state, attributes) in pending.items():
+            try:
+                self.set_state(entity_id, state=state, attributes=attributes)
+            except Exception as e:
+                self.log("Can`t update entity %s. Error: %s.", entity_id, e, level="ERROR")
+
+        self.flushes = self.flushes + 1
+        self.sent = self.sent + len(pending)
+
+        return len(pending)
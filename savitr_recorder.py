@@ -0,0 +1,202 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Raw message recorder: append-only log of fixed-size records, read back with mmap.
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+import mmap
+import os
+import struct
+import time
+
+# Record is a timestamp (seconds since epoch, little endian double) and a 192-byte message
+# after process_ingoing_message
+TIMESTAMP = struct.Struct('<d')
+MESSAGE_SIZE = 192
+RECORD_SIZE = TIMESTAMP.size + MESSAGE_SIZE
+
+# Segment files are named <device_name>-<timestamp of the first record>.frames
+SEGMENT_SUFFIX = '.frames'
+
+# One day of messages (1 per second) per segment
+SEGMENT_RECORDS = 86400
+
+
+def segment_paths(directory, device_name):
+    """
+    Find segments of device, oldest first.
+    Returns: list of (start timestamp, path)
+    """
+
+    prefix = device_name + '-'
+    segments = []
+    for name in os.listdir(directory):
+        if not name.startswith(prefix) or not name.endswith(SEGMENT_SUFFIX):
+            continue
+        start = name[len(prefix):-len(SEGMENT_SUFFIX)]
+        if start.isdigit():
+            segments.append((int(start), os.path.join(directory, name)))
+
+    return sorted(segments)
+
+
+class FrameRecorder:
+    """
+    Appends messages of one device to segment files in directory.
+
+    A new segment is started after segment_records records, only segments_max newest segments are kept
+    (0 - keep all). Records are written at most once in interval seconds.
+    """
+
+    def __init__(self, directory, device_name, segment_records=SEGMENT_RECORDS, segments_max=0, interval=0.0):
+        self.directory = directory
+        self.device_name = device_name
+        self.segment_records = segment_records
+        self.segments_max = segments_max
+        self.interval = interval
+
+        self.file = None
+        self.records = 0
+        self.last_timestamp = 0.0
+        self.record_buffer = bytearray(RECORD_SIZE)
+
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, message, timestamp=None):
+        """
+        Append message to the current segment.
+        Returns: True if it was recorded
+        """
+
+        if timestamp is None:
+            timestamp = time.time()
+        if timestamp - self.last_timestamp < self.interval:
+            return False
+        self.last_timestamp = timestamp
+
+        if self.file is None or self.records >= self.segment_records:
+            self.rotate(timestamp)
+
+        # One write of the whole record, so a record is never split by another writer
+        TIMESTAMP.pack_into(self.record_buffer, 0, timestamp)
+        self.record_buffer[TIMESTAMP.size:] = message
+        self.file.write(self.record_buffer)
+        self.records = self.records + 1
+
+        return True
+
+    def rotate(self, timestamp):
+        """
+        Start a new segment and delete the oldest ones.
+        """
+
+        self.close()
+
+        path = os.path.join(self.directory, "{}-{}{}".format(self.device_name, int(timestamp), SEGMENT_SUFFIX))
+        self.file = open(path, 'ab', buffering=0)
+
+        # Segment can exist after restart within the same second, cut its incomplete record
+        size = self.file.seek(0, os.SEEK_END)
+        if size % RECORD_SIZE:
+            self.file.truncate(size - size % RECORD_SIZE)
+        self.records = size // RECORD_SIZE
+
+        if self.segments_max:
+            for start, old_path in segment_paths(self.directory, self.device_name)[:-self.segments_max]:
+                os.remove(old_path)
+
+    def close(self):
+        """
+        Close the current segment.
+        """
+
+        if self.file:
+            self.file.close()
+        self.file = None
+
+
+class FrameSegment:
+    """
+    Memory-mapped segment file: records by index and search by time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+
+        # Incomplete record at the end (it is being written) is skipped
+        self.count = size // RECORD_SIZE
+
+    def __len__(self):
+        return self.count
+
+    def timestamp(self, index):
+        """
+        Returns: timestamp of record
+        """
+
+        return TIMESTAMP.unpack_from(self.mmap, index * RECORD_SIZE)[0]
+
+    def message(self, index):
+        """
+        Returns: 192-byte message of record
+        """
+
+        offset = index * RECORD_SIZE + TIMESTAMP.size
+
+        return self.mmap[offset:offset + MESSAGE_SIZE]
+
+    def find(self, timestamp):
+        """
+        Bisect for the first record not older than timestamp.
+        Returns: index, len(self) if all records are older
+        """
+
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def close(self):
+        if self.mmap:
+            self.mmap.close()
+        self.mmap = None
+
+
+def read_range(directory, device_name, start=None, end=None):
+    """
+    Read recorded messages of device from start to end timestamps (None - without limit).
+    Yields: (timestamp, message)
+    """
+
+    segments = segment_paths(directory, device_name)
+
+    for i, (segment_start, path) in enumerate(segments):
+
+        # Segment ends before the next one starts
+        if start is not None and i + 1 < len(segments) and segments[i + 1][0] <= start:
+            continue
+        if end is not None and segment_start > end:
+            break
+
+        segment = FrameSegment(path)
+        try:
+            index = segment.find(start) if start is not None else 0
+            while index < len(segment):
+                timestamp = segment.timestamp(index)
+                if end is not None and timestamp > end:
+                    return
+                yield timestamp, segment.message(index)
+                index = index + 1
+        finally:
+            segment.close()
@@ -0,0 +1,168 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Replay of recorded messages through the decoder into CSV or SQLite. Not an AppDaemon app.
+#
+# Run: python savitr_replay.py --dir /config/appdaemon/savitr_frames --device savitr --output history.sqlite
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+import argparse
+import csv
+import sqlite3
+import sys
+import time
+import savitr_dicts as dicts
+import savitr_codec as codec
+import savitr_recorder as recorder
+
+# SQLite column types by decoded value type
+SQLITE_TYPES = {
+    float: 'REAL',
+    int: 'INTEGER',
+    str: 'TEXT',
+}
+
+# Rows inserted into SQLite at once
+SQLITE_BATCH = 10000
+
+
+def decode_records(records, fields, skipped=None):
+    """
+    Decode recorded messages with the same decoder as push mode: only changed fields of every message.
+    Messages which can`t be decoded (eg. a code which is not in dicts.PARAMETERS yet) are skipped
+    and appended to skipped list as (timestamp, error).
+    Yields: (timestamp, list of values of fields)
+    """
+
+    previous = None
+    state = {}
+
+    for timestamp, message in records:
+        try:
+            if previous is None:
+                changes = codec.decode_message(message)
+            else:
+                changes = codec.decode_changes(message, previous)
+        except Exception as e:
+            if skipped is not None:
+                skipped.append((timestamp, e))
+            continue
+
+        # Previous message is the last decoded one, so fields of skipped messages are decoded again
+        state.update(changes)
+        previous = message
+
+        yield timestamp, [state[name] for name in fields]
+
+
+def write_csv(rows, fields, output):
+    """
+    Write rows into CSV file ('-' - stdout).
+    Returns: number of rows
+    """
+
+    f = sys.stdout if output == '-' else open(output, 'w', newline='')
+    count = 0
+
+    try:
+        writer = csv.writer(f)
+        writer.writerow(['timestamp'] + fields)
+        for timestamp, values in rows:
+            writer.writerow([timestamp] + values)
+            count = count + 1
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    return count
+
+
+def write_sqlite(rows, fields, output, device_name):
+    """
+    Write rows into 'frames' table of SQLite database. Fields of rows with the same device and timestamp are updated
+    (other fields are kept), columns of new fields are added, so history can be decoded again after
+    dicts.PARAMETERS are improved.
+    Returns: number of rows
+    """
+
+    connection = sqlite3.connect(output)
+    count = 0
+
+    try:
+        connection.execute('CREATE TABLE IF NOT EXISTS frames (device TEXT NOT NULL, timestamp REAL NOT NULL, '
+                           'PRIMARY KEY (device, timestamp))')
+        columns = {row[1] for row in connection.execute('PRAGMA table_info(frames)')}
+
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return 0
+
+        # Column types are taken from the first decoded message
+        for name, value in zip(fields, first[1]):
+            if name not in columns:
+                connection.execute('ALTER TABLE frames ADD COLUMN "{}" {}'.format(name, SQLITE_TYPES[type(value)]))
+
+        # Only selected fields are updated in existing rows, the rest of them are kept
+        sql = ('INSERT INTO frames (device, timestamp, {}) VALUES (?, ?, {}) '
+               'ON CONFLICT (device, timestamp) DO UPDATE SET {}').format(
+            ', '.join('"{}"'.format(name) for name in fields), ', '.join('?' * len(fields)),
+            ', '.join('"{0}" = excluded."{0}"'.format(name) for name in fields))
+
+        batch = [[device_name, first[0]] + first[1]]
+        for timestamp, values in rows:
+            batch.append([device_name, timestamp] + values)
+            if len(batch) >= SQLITE_BATCH:
+                connection.executemany(sql, batch)
+                count = count + len(batch)
+                batch = []
+        connection.executemany(sql, batch)
+        count = count + len(batch)
+
+        connection.commit()
+    finally:
+        connection.close()
+
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode recorded Savitr messages into CSV or SQLite.")
+    parser.add_argument('--dir', required=True, help="Directory of recorded segments (record_dir).")
+    parser.add_argument('--device', required=True, help="Device name.")
+    parser.add_argument('--start', type=float, help="First timestamp, seconds since epoch.")
+    parser.add_argument('--end', type=float, help="Last timestamp, seconds since epoch.")
+    parser.add_argument('--fields', help="Comma separated parameters. All of them by default.")
+    parser.add_argument('--format', choices=['csv', 'sqlite'], help="By default it is guessed from output.")
+    parser.add_argument('--output', default='-', help="Output file, '-' - CSV to stdout.")
+    args = parser.parse_args()
+
+    fields = args.fields.split(',') if args.fields else list(dicts.PARAMETERS)
+    for name in fields:
+        if name not in dicts.PARAMETERS:
+            raise Exception("Unknown parameter {}".format(name))
+
+    output_format = args.format
+    if output_format is None:
+        output_format = 'sqlite' if args.output.endswith(('.sqlite', '.db')) else 'csv'
+
+    start = time.perf_counter()
+    skipped = []
+    rows = decode_records(recorder.read_range(args.dir, args.device, args.start, args.end), fields, skipped)
+    if output_format == 'sqlite':
+        count = write_sqlite(rows, fields, args.output, args.device)
+    else:
+        count = write_csv(rows, fields, args.output)
+    seconds = time.perf_counter() - start
+
+    print("{} messages in {:.3f} s ({:.0f} messages/s).".format(count, seconds, count / seconds if seconds else 0),
+          file=sys.stderr)
+    if skipped:
+        print("{} messages can`t be decoded and are skipped, the first one at {}: {!r}.".format(
+            len(skipped), skipped[0][0], skipped[0][1]), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
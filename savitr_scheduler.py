@@ -0,0 +1,69 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Adaptive polling scheduler.
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+# Changes of these fields mean that something is going on: heater is controlled or temperatures are moving
+ACTIVITY_FIELDS = frozenset([
+    'heating_mode',
+    'heater_status',
+    'heating_power',
+    'air_indoor_temp_control',
+    'coolant_temp',
+    'air_indoor_temp',
+    'air_outdoor_temp',
+    'coolant_temp_setpoint',
+    'air_indoor_temp_setpoint',
+])
+
+
+class PollScheduler:
+    """
+    Adaptive poll interval.
+
+    Interval drops to floor right after commands or when activity fields change. When decoded messages are
+    stable for stable_polls polls in a row, interval doubles up to ceiling.
+    """
+
+    def __init__(self, floor, ceiling, stable_polls=3):
+        if floor <= 0 or floor > ceiling:
+            raise Exception("Poll interval floor ({}) must be positive and not more than ceiling ({})".format(
+                floor, ceiling))
+
+        self.floor = floor
+        self.ceiling = ceiling
+        self.stable_polls = stable_polls
+
+        self.interval = floor
+        self.stable = 0
+
+    def activity(self):
+        """
+        Something is going on: poll as fast as possible.
+        """
+
+        self.interval = self.floor
+        self.stable = 0
+
+    def next_interval(self, changes):
+        """
+        Compute interval to the next poll.
+
+        In:
+         - changes - fields published on this poll
+        Returns: seconds
+        """
+
+        if not ACTIVITY_FIELDS.isdisjoint(changes):
+            self.activity()
+            return self.interval
+
+        self.stable = self.stable + 1
+        if self.stable >= self.stable_polls:
+            self.interval = min(self.interval * 2, self.ceiling)
+            self.stable = 0
+
+        return self.interval
@@ -0,0 +1,356 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Simulator of WiFi module for load and latency tests. Not an AppDaemon app.
+#
+# Run: python savitr_simulator.py --port 8558 --devices 100
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+import argparse
+import asyncio
+import json
+import random
+import savitr_dicts as dicts
+import savitr_codec as codec
+
+# State of a heater right after power on
+DEFAULT_STATE = {
+    "msg_preamble": "EZAP",
+    "mac": "5CCF7F000001",
+    "port": "8558",
+    "wifi_ssid": "SAVITR_WIFI\0\0\0\0\0",
+    "wifi_ssid_length": 11,
+    "wifi_password": "\0" * 8,
+    "stat_preamble": "STAT",
+    "cmd_count": 0,
+    "cmd_code": 0,
+    "power_supply_state": "on",
+    "power_supply_loss_time": 0,
+    "heating_mode": "coolant_temp_constant",
+    "heater_status": "on",
+    "heating_power": 100,
+    "air_indoor_temp_control": "off",
+    "coolant_temp": 45.0,
+    "air_indoor_temp": 19.5,
+    "air_outdoor_temp": -7.3,
+    "clock_weekday": "monday",
+    "clock_hours": 12,
+    "clock_minutes": 0,
+    "clock_seconds": 0,
+    "coolant_temp_setpoint": 60.0,
+    "air_indoor_temp_setpoint": 20.0,
+    "coolant_temp_min": 5.0,
+    "coolant_temp_max": 90.0,
+    "air_indoor_temp_min": 5.0,
+    "air_indoor_temp_max": 35.0,
+    "checksum": 0,
+}
+
+
+class HeaterSimulator:
+    """
+    Simulated heater with WiFi module: builds status messages from its state and applies commands.
+    """
+
+    def __init__(self, state=None, seed=None):
+        self.state = dict(DEFAULT_STATE)
+        if state:
+            self.state.update(state)
+        self.random = random.Random(seed)
+        self.commands_received = 0
+
+    def build_frame(self):
+        """
+        Build 192-byte status message from state, as WiFi module sends it.
+        Returns: bytes
+        """
+
+        message = codec.encode_message(self.state)
+        codec.pack_message(message)
+
+        return bytes(message)
+
+    def tick(self):
+        """
+        Move heater's clock and temperatures one second forward.
+        """
+
+        state = self.state
+
+        state['clock_seconds'] = (state['clock_seconds'] + 1) % 60
+        if state['clock_seconds'] == 0:
+            state['clock_minutes'] = (state['clock_minutes'] + 1) % 60
+
+        # Coolant goes to setpoint when heating is on, air temperatures drift a bit
+        if state['heating_mode'] != 'heating_off' and state['coolant_temp'] < state['coolant_temp_setpoint']:
+            state['coolant_temp'] = round(state['coolant_temp'] + 0.1 * state['heating_power'] / 100, 1)
+        elif state['coolant_temp'] > state['air_indoor_temp']:
+            state['coolant_temp'] = round(state['coolant_temp'] - 0.1, 1)
+        state['air_indoor_temp'] = round(state['air_indoor_temp'] + self.random.choice([-0.1, 0, 0, 0.1]), 1)
+        state['air_outdoor_temp'] = round(state['air_outdoor_temp'] + self.random.choice([-0.1, 0, 0, 0.1]), 1)
+
+    def apply_command(self, message):
+        """
+        Apply 192-byte command message from the app, like WiFi module does.
+        Returns: True if message was accepted
+        """
+
+        message = codec.unpack_message(bytearray(message))
+        if not codec.verify_checksum(message, 'write'):
+            return False
+
+        self.commands_received = self.commands_received + 1
+
+        # Command is read with the same write layout as it was built (see savitr_codec.CommandEncoder)
+        state = self.state
+        code = message[dicts.PARAMETERS['cmd_code']['write']['byte_start']]
+        command = codec.COMMAND_CODES.get(code)
+
+        if command is not None:
+            values = command.unpack(message)
+            for name in command.fields:
+                state[name] = values[name]
+
+            if command.name == 'set_air_indoor_temp_setpoint':
+                state['air_indoor_temp_control'] = 'on'
+            elif command.name == 'set_air_indoor_temp_control':
+                state['air_indoor_temp_control'] = 'off'
+
+        # Echo the command in status messages
+        state['cmd_count'] = message[dicts.PARAMETERS['cmd_count']['write']['byte_start']]
+        state['cmd_code'] = code
+
+        return True
+
+
+class SimulatorServer:
+    """
+    TCP server of one simulated WiFi module. Streams status messages and receives commands.
+
+    Faults can be injected:
+     - rate - messages per second;
+     - lag - seconds before a command is applied;
+     - partial - probability to send a truncated message;
+     - disconnect - probability to drop connection after a message.
+    """
+
+    def __init__(self, simulator=None, host='127.0.0.1', port=0, rate=1.0, lag=0.0, partial=0.0, disconnect=0.0,
+                 seed=None):
+        self.simulator = simulator or HeaterSimulator(seed=seed)
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.lag = lag
+        self.partial = partial
+        self.disconnect = disconnect
+        self.random = random.Random(seed)
+        self.server = None
+        self.frames_sent = 0
+
+    async def start(self):
+        """
+        Start listening. Port 0 means any free port, see self.port after start.
+        """
+
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        """
+        Stop listening.
+        """
+
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        """
+        Serve one client connection.
+        """
+
+        commands = asyncio.ensure_future(self.read_commands(reader))
+
+        try:
+            while True:
+                self.simulator.tick()
+                frame = self.simulator.build_frame()
+
+                if self.random.random() < self.partial:
+                    frame = frame[:self.random.randrange(1, codec.MESSAGE_SIZE)]
+
+                writer.write(frame)
+                await writer.drain()
+                self.frames_sent = self.frames_sent + 1
+
+                if self.random.random() < self.disconnect:
+                    break
+
+                await asyncio.sleep(1 / self.rate)
+        except ConnectionError:
+            pass
+        finally:
+            commands.cancel()
+            writer.close()
+
+    async def read_commands(self, reader):
+        """
+        Receive command messages and apply them.
+        """
+
+        try:
+            while True:
+                message = await reader.readexactly(codec.MESSAGE_SIZE)
+                if self.lag:
+                    await asyncio.sleep(self.lag)
+                self.simulator.apply_command(message)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+
+
+class FakeHomeAssistant:
+    """
+    Stand-in of Home Assistant REST API for tests: POST /api/states/<entity_id> with keep-alive and pipelining.
+    States are kept in self.states. With close_after the connection is closed (Connection: close) after so many
+    requests, like a proxy which limits keep-alive requests does.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, token='test', lag=0.0, close_after=0):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.lag = lag
+        self.close_after = close_after
+        self.server = None
+        self.states = {}
+        self.requests = 0
+        self.connections = 0
+
+    async def start(self):
+        """
+        Start listening. Port 0 means any free port, see self.port after start.
+        """
+
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        """
+        Stop listening.
+        """
+
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        """
+        Serve requests of one keep-alive connection one by one.
+        """
+
+        self.connections = self.connections + 1
+        served = 0
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode().split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in [b'\r\n', b'']:
+                        break
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                if self.lag:
+                    await asyncio.sleep(self.lag)
+                status, answer = self.process(method, path, headers, body)
+                self.requests = self.requests + 1
+                served = served + 1
+                closing = self.close_after and served >= self.close_after
+
+                answer = json.dumps(answer).encode()
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n{}\r\n".format(
+                    status, 'OK' if status < 300 else 'Error', len(answer),
+                    'Connection: close\r\n' if closing else '').encode() + answer)
+                await writer.drain()
+                if closing:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def process(self, method, path, headers, body):
+        """
+        Process one request.
+        Returns: status code and JSON answer
+        """
+
+        if headers.get('authorization') != 'Bearer ' + self.token:
+            return 401, {"message": "Unauthorized"}
+
+        if method != 'POST' or not path.startswith('/api/states/'):
+            return 404, {"message": "Not found"}
+
+        entity_id = path[len('/api/states/'):]
+        data = json.loads(body)
+        status = 200 if entity_id in self.states else 201
+        self.states[entity_id] = {"entity_id": entity_id, "state": str(data['state']),
+                                  "attributes": data.get('attributes', {})}
+
+        return status, self.states[entity_id]
+
+
+async def serve(args):
+    """
+    Start simulators on consecutive ports and serve forever.
+    """
+
+    servers = []
+    for i in range(args.devices):
+        server = SimulatorServer(host=args.host, port=args.port + i if args.port else 0, rate=args.rate,
+                                 lag=args.lag, partial=args.partial, disconnect=args.disconnect, seed=i)
+        await server.start()
+        servers.append(server)
+
+    # Ports are printed to let other programs find them
+    for server in servers:
+        print(server.port, flush=True)
+
+    # Home Assistant stand-in, its port is printed last
+    if args.hass:
+        hass = FakeHomeAssistant(host=args.host, port=args.hass_port, token=args.hass_token)
+        await hass.start()
+        print(hass.port, flush=True)
+
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulator of Savitr WiFi modules.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8558, help="First port, 0 - any free ports.")
+    parser.add_argument('--devices', type=int, default=1, help="Number of simulated modules.")
+    parser.add_argument('--rate', type=float, default=1.0, help="Messages per second.")
+    parser.add_argument('--lag', type=float, default=0.0, help="Seconds before a command is applied.")
+    parser.add_argument('--partial', type=float, default=0.0, help="Probability of a truncated message.")
+    parser.add_argument('--disconnect', type=float, default=0.0, help="Probability of a disconnect per message.")
+    parser.add_argument('--hass', action='store_true', help="Also start Home Assistant REST API stand-in.")
+    parser.add_argument('--hass-port', type=int, default=0, help="Port of Home Assistant stand-in.")
+    parser.add_argument('--hass-token', default='test', help="Access token of Home Assistant stand-in.")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Time-series store of decoded values with 1-minute, 1-hour and 1-day rollups in SQLite.
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+import sqlite3
+import threading
+import time
+from array import array
+
+# Fields which are stored and rolled up by default
+ROLLUP_FIELDS = ['coolant_temp', 'air_indoor_temp', 'air_outdoor_temp', 'heating_power']
+
+# Rollup resolutions: name -> bucket size in seconds. Hours and days are of local time (like energy counters),
+# so a day starts at local midnight and it is 23 or 25 hours long when the clock is changed
+RESOLUTIONS = {
+    '1m': 60,
+    '1h': 3600,
+    '1d': 86400,
+}
+
+# Samples kept in memory before they are written
+FLUSH_SIZE = 60
+
+# Raw samples are kept for 7 days, rollups forever
+RAW_RETENTION = 7 * 86400
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS samples (device TEXT NOT NULL, field TEXT NOT NULL, timestamp REAL NOT NULL, '
+    'value REAL, PRIMARY KEY (device, field, timestamp))',
+    'CREATE TABLE IF NOT EXISTS rollups (device TEXT NOT NULL, field TEXT NOT NULL, resolution TEXT NOT NULL, '
+    'start INTEGER NOT NULL, min REAL, max REAL, sum REAL, count INTEGER, '
+    'PRIMARY KEY (device, field, resolution, start))',
+]
+
+# Buckets which were written partially (eg. before restart) are merged
+UPSERT_ROLLUP = (
+    'INSERT INTO rollups (device, field, resolution, start, min, max, sum, count) VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+    'ON CONFLICT (device, field, resolution, start) DO UPDATE SET '
+    'min = MIN(min, excluded.min), max = MAX(max, excluded.max), sum = sum + excluded.sum, '
+    'count = count + excluded.count')
+
+
+class Bucket:
+    """
+    Open rollup bucket of one field and resolution.
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.sum = 0.0
+        self.count = 0
+
+    def add(self, value):
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+
+class TimeSeriesStore:
+    """
+    Stores values of fields of one device.
+
+    Samples are collected in array-backed columns (one array of timestamps and one array per field) and written
+    to SQLite every FLUSH_SIZE samples. Rollups are computed on write: every sample goes into open 1-minute,
+    1-hour and 1-day buckets (hours and days of local time), closed buckets are written with min, max, sum
+    and count.
+    """
+
+    def __init__(self, path, device_name, fields=None, flush_size=FLUSH_SIZE, raw_retention=RAW_RETENTION):
+        self.device_name = device_name
+        self.fields = list(fields or ROLLUP_FIELDS)
+        self.flush_size = flush_size
+        self.raw_retention = raw_retention
+
+        self.timestamps = array('d')
+        self.columns = {name: array('d') for name in self.fields}
+
+        self.buckets = {}
+        self.closed = []
+
+        # Current local hour and day: (start, end) timestamps
+        self.hour = (0, 0)
+        self.day = (0, 0)
+
+        # Store is written by polls and read by reports from different threads
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        for sql in SCHEMA:
+            self.connection.execute(sql)
+        self.connection.commit()
+
+    def add(self, timestamp, state):
+        """
+        Add values of fields from decoded state.
+        """
+
+        with self.lock:
+            starts = self.bucket_starts(timestamp)
+            self.timestamps.append(timestamp)
+            for name in self.fields:
+                value = float(state[name])
+                self.columns[name].append(value)
+
+                for resolution, start in starts.items():
+                    bucket = self.buckets.get((name, resolution))
+                    if bucket is None or bucket.start != start:
+                        if bucket is not None:
+                            self.closed.append((name, resolution, bucket))
+                        bucket = self.buckets[(name, resolution)] = Bucket(start)
+                    bucket.add(value)
+
+            if len(self.timestamps) >= self.flush_size or self.closed:
+                self.write()
+
+    def bucket_starts(self, timestamp):
+        """
+        Starts of buckets of sample. Local hour and day are cached, time.localtime is called once an hour.
+        Returns: dict of resolution: start timestamp
+        """
+
+        if not self.hour[0] <= timestamp < self.hour[1]:
+            local = time.localtime(timestamp)
+            start = int(timestamp) - local.tm_min * 60 - local.tm_sec
+            self.hour = (start, start + RESOLUTIONS['1h'])
+
+            # Day always starts with an hour
+            if not self.day[0] <= timestamp < self.day[1]:
+                self.day = (int(time.mktime(local[:3] + (0, 0, 0, 0, 0, -1))),
+                            int(time.mktime((local.tm_year, local.tm_mon, local.tm_mday + 1, 0, 0, 0, 0, 0, -1))))
+
+        return {'1m': int(timestamp // RESOLUTIONS['1m'] * RESOLUTIONS['1m']), '1h': self.hour[0], '1d': self.day[0]}
+
+    def write(self):
+        """
+        Write collected samples and closed buckets (lock is held by caller).
+        """
+
+        samples = []
+        for name, column in self.columns.items():
+            samples.extend(zip([self.device_name] * len(column), [name] * len(column), self.timestamps, column))
+
+        rollups = [(self.device_name, name, resolution, bucket.start, bucket.min, bucket.max, bucket.sum, bucket.count)
+                   for name, resolution, bucket in self.closed]
+
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?)', samples)
+            self.connection.executemany(UPSERT_ROLLUP, rollups)
+
+            # Forget old samples once an hour
+            if any(resolution == '1h' for name, resolution, bucket in self.closed) and self.timestamps:
+                self.connection.execute('DELETE FROM samples WHERE device = ? AND timestamp < ?',
+                                        (self.device_name, self.timestamps[-1] - self.raw_retention))
+
+        del self.timestamps[:]
+        for column in self.columns.values():
+            del column[:]
+        self.closed = []
+
+    def flush(self):
+        """
+        Write everything, also open buckets (they are merged with the rest of them later).
+        """
+
+        with self.lock:
+            for (name, resolution), bucket in self.buckets.items():
+                self.closed.append((name, resolution, bucket))
+            self.buckets = {}
+            self.write()
+
+    def close(self):
+        """
+        Flush and close database.
+        """
+
+        self.flush()
+        self.connection.close()
+
+    def query(self, field, resolution=None, start=0, end=float('inf')):
+        """
+        Read samples (resolution None) or rollups of field.
+        Returns: list of (timestamp, value) or list of (start, min, max, avg)
+        """
+
+        with self.lock:
+            if resolution is None:
+                return self.connection.execute(
+                    'SELECT timestamp, value FROM samples WHERE device = ? AND field = ? AND timestamp BETWEEN ? AND ? '
+                    'ORDER BY timestamp', (self.device_name, field, start, end)).fetchall()
+
+            return self.connection.execute(
+                'SELECT start, min, max, sum / count FROM rollups '
+                'WHERE device = ? AND field = ? AND resolution = ? AND start BETWEEN ? AND ? ORDER BY start',
+                (self.device_name, field, resolution, start, end)).fetchall()
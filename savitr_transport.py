@@ -0,0 +1,501 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Transports to communicate with WiFi module.
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+import asyncio
+import random
+import socket
+import threading
+import time
+
+# WiFi module sends a message of 192 bytes every 1 second
+FRAME_SIZE = 192
+
+# Every message starts with message preamble and has status preamble at 60-63 bytes
+FRAME_PREAMBLE = b'EZAP'
+FRAME_STAT_PREAMBLE = b'STAT'
+FRAME_STAT_OFFSET = 60
+
+# How many bytes to read from socket at once
+READ_SIZE = 4096
+
+# Size of buffer to drain socket (more than 5 minutes of messages)
+DRAIN_SIZE = 65536
+
+# Connection states of ConnectionSupervisor
+CONNECTED = 'connected'
+BACKING_OFF = 'backing_off'
+CIRCUIT_OPEN = 'circuit_open'
+
+# One event loop in a background thread for all heaters of all apps
+_shared_loop = None
+_shared_loop_lock = threading.Lock()
+
+
+class FrameBuffer:
+    """
+    Frames the byte stream from WiFi module into messages and keeps the newest complete one.
+
+    The stream is framed by 'EZAP' preamble and 192-byte length, so partial messages and garbage are skipped
+    and a misaligned stream is synchronized again.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+        # Latest message and its sequence number (for waiting of the next one)
+        self.frame = None
+        self.frame_count = 0
+        self.bytes_dropped = 0
+        self.condition = threading.Condition()
+
+        # Push mode: on_frame(frame) is called for new messages, one call at a time
+        self.on_frame = None
+        self.delivered_count = 0
+        self.delivering = False
+        self.delivery_lock = threading.Lock()
+
+        # Recording: on_message(frame) is called for every complete message, in the receiving thread
+        self.on_message = None
+
+    def feed(self, data):
+        """
+        Add received bytes. Keep the newest complete message.
+        """
+
+        buffer = self.buffer
+        buffer += data
+        frame = None
+
+        while True:
+            start = buffer.find(FRAME_PREAMBLE)
+
+            # No preamble - keep only a tail which can be the beginning of it
+            if start < 0:
+                tail = len(FRAME_PREAMBLE) - 1
+                if len(buffer) > tail:
+                    self.bytes_dropped = self.bytes_dropped + len(buffer) - tail
+                    del buffer[:-tail]
+                break
+
+            # Skip garbage before preamble
+            if start > 0:
+                self.bytes_dropped = self.bytes_dropped + start
+                del buffer[:start]
+
+            # Wait for the rest of message
+            if len(buffer) < FRAME_SIZE:
+                break
+
+            # Preamble inside of some data - skip it and search again
+            if buffer[FRAME_STAT_OFFSET:FRAME_STAT_OFFSET + len(FRAME_STAT_PREAMBLE)] != FRAME_STAT_PREAMBLE:
+                self.bytes_dropped = self.bytes_dropped + 1
+                del buffer[:1]
+                continue
+
+            # Truncated message followed by the next one - skip to the next one. A preamble after the header (where
+            # the status and markers are) can only be the next message, in the header it must have its own status.
+            following = buffer.find(FRAME_PREAMBLE, 1, FRAME_SIZE)
+            if following > 0:
+                stat_start = following + FRAME_STAT_OFFSET
+                if following >= FRAME_STAT_OFFSET or \
+                        buffer[stat_start:stat_start + len(FRAME_STAT_PREAMBLE)] == FRAME_STAT_PREAMBLE:
+                    self.bytes_dropped = self.bytes_dropped + following
+                    del buffer[:following]
+                    continue
+
+            frame = bytes(buffer[:FRAME_SIZE])
+            del buffer[:FRAME_SIZE]
+            if self.on_message is not None:
+                self.on_message(frame)
+
+        if frame is not None:
+            self.put_frame(frame)
+
+    def clear(self):
+        """
+        Forget incomplete message (eg. after reconnect).
+        """
+
+        self.buffer.clear()
+
+    def put_frame(self, frame):
+        """
+        Keep the latest message and wake up everybody who waits for it.
+        """
+
+        with self.condition:
+            self.frame = frame
+            self.frame_count = self.frame_count + 1
+            self.condition.notify_all()
+
+    def start_delivery(self):
+        """
+        Check if there is a message for on_frame callback which nobody delivers yet.
+        Returns: True if caller must call deliver() (right now or in another thread)
+        """
+
+        if self.on_frame is None:
+            return False
+
+        with self.delivery_lock:
+            if self.delivering or self.frame_count == self.delivered_count:
+                return False
+            self.delivering = True
+
+        return True
+
+    def deliver(self):
+        """
+        Call on_frame with the latest message until there is no newer one. Older messages are skipped.
+        """
+
+        while True:
+            with self.delivery_lock:
+                with self.condition:
+                    frame_count = self.frame_count
+                    frame = self.frame
+                if frame_count == self.delivered_count:
+                    self.delivering = False
+                    return
+                self.delivered_count = frame_count
+
+            try:
+                self.on_frame(frame)
+            except Exception:
+                with self.delivery_lock:
+                    self.delivering = False
+                raise
+
+    def wait_next_frame(self, timeout):
+        """
+        Wait for a message which arrives after this call (from another thread).
+        Returns: bytes or None
+        """
+
+        with self.condition:
+            frame_count = self.frame_count
+            self.condition.wait_for(lambda: self.frame_count != frame_count, timeout)
+            if self.frame_count == frame_count:
+                return None
+            return self.frame
+
+
+def drain(sock, buffer, frames=None):
+    """
+    Remove the data present on the socket with large non-blocking reads into a reused buffer.
+    If frames (FrameBuffer) is given, the data is framed into it, so the latest message is kept.
+    Returns: tuple (bytes discarded, messages discarded)
+    """
+
+    bytes_drained = 0
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+
+    try:
+        while True:
+            try:
+                bytes_quantity = sock.recv_into(buffer)
+            except (BlockingIOError, InterruptedError):
+                break
+
+            # Connection is closed - nothing to drain anymore
+            if bytes_quantity == 0:
+                break
+
+            bytes_drained = bytes_drained + bytes_quantity
+            if frames is not None:
+                frames.feed(memoryview(buffer)[:bytes_quantity])
+    finally:
+        sock.settimeout(timeout)
+
+    return bytes_drained, bytes_drained // FRAME_SIZE
+
+
+def shared_loop():
+    """
+    Get event loop which is shared by all async transports. Start it in a background thread at first call.
+    """
+
+    global _shared_loop
+
+    with _shared_loop_lock:
+        if _shared_loop is None:
+            _shared_loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_shared_loop.run_forever, name="savitr-transport", daemon=True)
+            thread.start()
+
+    return _shared_loop
+
+
+class ConnectionSupervisor:
+    """
+    Connection state machine: connected, backing off and open circuit.
+
+    Every failure doubles the delay before the next attempt (with jitter, so many heaters which went offline
+    together don't reconnect at the same moment). After circuit_threshold failures in a row the circuit opens:
+    the device is considered offline and only one attempt is made every circuit_timeout seconds.
+    Nothing sleeps here, the owner asks can_attempt() or sleeps for the returned delay by itself.
+    """
+
+    def __init__(self, backoff_min=1.0, backoff_max=300.0, circuit_threshold=5, circuit_timeout=300.0):
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.circuit_threshold = circuit_threshold
+        self.circuit_timeout = circuit_timeout
+
+        self.state = CONNECTED
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def success(self):
+        """
+        Connection is fine.
+        Returns: True if it was not connected before
+        """
+
+        recovered = self.state != CONNECTED
+        self.state = CONNECTED
+        self.failures = 0
+
+        return recovered
+
+    def failure(self):
+        """
+        Connection attempt failed or connection is broken.
+        Returns: delay before the next attempt, in seconds
+        """
+
+        self.failures = self.failures + 1
+
+        if self.failures >= self.circuit_threshold:
+            self.state = CIRCUIT_OPEN
+            delay = self.circuit_timeout
+        else:
+            self.state = BACKING_OFF
+            delay = min(self.backoff_min * 2 ** (self.failures - 1), self.backoff_max)
+
+        # Equal jitter: at least half of the delay
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        self.retry_at = time.monotonic() + delay
+
+        return delay
+
+    def can_attempt(self):
+        """
+        Check if it is time to connect.
+        """
+
+        return self.state == CONNECTED or time.monotonic() >= self.retry_at
+
+
+class AsyncTransport:
+    """
+    Asyncio connection to WiFi module.
+
+    A reader task keeps the connection open, consumes the message stream of the module and keeps the latest
+    message. If connection is broken it reconnects with exponential backoff and does not block anybody.
+
+    Sync apps start it on shared_loop() with start(). Async apps can run it in their own loop:
+    self.create_task(transport.run()).
+    """
+
+    def __init__(self, host, port, timeout, supervisor=None, log=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.supervisor = supervisor or ConnectionSupervisor()
+        self.log = log or (lambda *args, **kwargs: None)
+
+        self.loop = None
+        self.task = None
+        self.writer = None
+        self.connected = False
+
+        self.frames = FrameBuffer()
+
+    def start(self, loop):
+        """
+        Start reader task in event loop running in another thread.
+        """
+
+        self.loop = loop
+        self.task = asyncio.run_coroutine_threadsafe(self.run(), loop)
+
+    def stop(self):
+        """
+        Stop reader task and close connection.
+        """
+
+        if self.task:
+            self.task.cancel()
+        self.task = None
+
+    async def run(self):
+        """
+        Reader task: connect, read messages forever and reconnect with backoff.
+        """
+
+        while True:
+            try:
+                self.log("Connecting to %s:%s.", self.host, self.port, level="INFO")
+                reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port), self.timeout)
+                self.connected = True
+                self.log("Connected to %s:%s.", self.host, self.port, level="INFO")
+
+                self.frames.clear()
+                while True:
+                    data = await asyncio.wait_for(reader.read(READ_SIZE), self.timeout)
+                    if not data:
+                        raise EOFError("Connection is closed by device")
+                    self.frames.feed(data)
+
+                    # Push mode: decode and publish in executor, so the event loop is not blocked
+                    if self.frames.start_delivery():
+                        asyncio.get_running_loop().run_in_executor(None, self.frames.deliver)
+
+                    # Connection is fine, so start from the short backoff next time
+                    self.supervisor.success()
+
+            except (OSError, EOFError, asyncio.TimeoutError) as e:
+                delay = self.supervisor.failure()
+                self.log("Can`t read from %s:%s. Error: %r. Reconnecting after %.1f s (%s).",
+                         self.host, self.port, e, delay, self.supervisor.state, level="ERROR")
+            finally:
+                self.connected = False
+                if self.writer:
+                    self.writer.close()
+                self.writer = None
+
+            await asyncio.sleep(delay)
+
+    async def send(self, message):
+        """
+        Write message to WiFi module.
+        Returns: number of bytes sent
+        """
+
+        if not self.writer:
+            raise ConnectionError("Not connected to {}:{}".format(self.host, self.port))
+
+        self.writer.write(message)
+        await self.writer.drain()
+
+        return len(message)
+
+    def send_threadsafe(self, message):
+        """
+        Write message to WiFi module from another thread.
+        Returns: number of bytes sent
+        """
+
+        future = asyncio.run_coroutine_threadsafe(self.send(message), self.loop)
+
+        return future.result(self.timeout)
+
+
+class ThreadTransport:
+    """
+    Blocking socket connection to WiFi module in a background thread.
+
+    The thread reads the message stream all the time and keeps the latest message, so readers never touch
+    the socket. If connection is broken it reconnects with exponential backoff in its own thread.
+    """
+
+    def __init__(self, host, port, timeout, supervisor=None, log=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.supervisor = supervisor or ConnectionSupervisor()
+        self.log = log or (lambda *args, **kwargs: None)
+
+        self.thread = None
+        self.socket = None
+        self.socket_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.connected = False
+
+        self.frames = FrameBuffer()
+
+    def start(self):
+        """
+        Start reader thread.
+        """
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="savitr-reader-{}".format(self.host), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop reader thread and close connection.
+        """
+
+        self.stopped.set()
+        with self.socket_lock:
+            if self.socket:
+                try:
+                    self.socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def run(self):
+        """
+        Reader thread: connect, read messages forever and reconnect with backoff.
+        """
+
+        while not self.stopped.is_set():
+            delay = 0
+            try:
+                self.log("Connecting to %s:%s.", self.host, self.port, level="INFO")
+                sock = socket.create_connection((self.host, self.port), self.timeout)
+                with self.socket_lock:
+                    self.socket = sock
+                self.connected = True
+                self.log("Connected to %s:%s.", self.host, self.port, level="INFO")
+
+                self.frames.clear()
+                while not self.stopped.is_set():
+                    data = sock.recv(READ_SIZE)
+                    if not data:
+                        raise EOFError("Connection is closed by device")
+                    self.frames.feed(data)
+
+                    # Push mode: decode and publish right in reader thread
+                    if self.frames.start_delivery():
+                        self.frames.deliver()
+
+                    # Connection is fine, so start from the short backoff next time
+                    self.supervisor.success()
+
+            except (OSError, EOFError) as e:
+                if not self.stopped.is_set():
+                    delay = self.supervisor.failure()
+                    self.log("Can`t read from %s:%s. Error: %r. Reconnecting after %.1f s (%s).",
+                             self.host, self.port, e, delay, self.supervisor.state, level="ERROR")
+            finally:
+                self.connected = False
+                with self.socket_lock:
+                    if self.socket:
+                        self.socket.close()
+                    self.socket = None
+
+            self.stopped.wait(delay)
+
+    def send_threadsafe(self, message):
+        """
+        Write message to WiFi module.
+        Returns: number of bytes sent
+        """
+
+        with self.socket_lock:
+            if not self.socket:
+                raise ConnectionError("Not connected to {}:{}".format(self.host, self.port))
+            self.socket.sendall(message)
+
+        return len(message)
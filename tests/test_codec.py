@@ -0,0 +1,142 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Tests of message codec against the original while-loop processing.
+#
+# Run: python -m pytest tests
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+import os
+import random
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import savitr_codec as codec  # noqa: E402
+
+# Random messages of every test
+MESSAGES = 20000
+
+
+def reference_process_ingoing_message(message):
+    """
+    Original SavitrHeater.process_ingoing_message.
+    Returns: bytearray
+    """
+
+    i = 64
+    while i < 192:
+        message[i] = message[i] & 0xff
+        i = i + 1
+
+    i = 128
+    while i < 192:
+        if message[i] == 127:
+            message[i - 64] = message[i - 64] + 128
+        i = i + 1
+
+    return message
+
+
+def reference_process_outgoing_message(message):
+    """
+    Original SavitrHeater.process_outgoing_message.
+    Returns: bytearray
+    """
+
+    i = 64
+    while i < 128:
+        if message[i] > 127:
+            message[i] = message[i] & 0x7f
+            message[i + 64] = 127
+        else:
+            message[i + 64] = 0
+        i = i + 1
+
+    return message
+
+
+def reference_calculate_checksum(msg, size):
+    """
+    Original SavitrHeater.calculate_checksum.
+    Returns: int
+    """
+
+    checksum = 0
+
+    while size != 0:
+        checksum = checksum + (msg[size] * size)
+        size = size - 1
+
+    return checksum & 0xffffffff
+
+
+def random_message(generator):
+    """
+    Random message as the device sends it: marked payload bytes are 7-bit, markers are 0 or 127.
+    Returns: bytearray
+    """
+
+    message = bytearray(generator.getrandbits(8) for i in range(codec.MESSAGE_SIZE))
+    for i in range(codec.MARKERS_START, codec.MESSAGE_SIZE):
+        message[i] = generator.choice([0, 127])
+        if message[i] == 127:
+            message[i - codec.PAYLOAD_LENGTH] = message[i - codec.PAYLOAD_LENGTH] & 0x7f
+
+    return message
+
+
+@pytest.fixture
+def generator():
+    return random.Random(8558)
+
+
+def test_unpack_message_is_identical(generator):
+    for i in range(MESSAGES):
+        message = random_message(generator)
+        expected = reference_process_ingoing_message(bytearray(message))
+
+        assert codec.unpack_message(message) == expected
+
+
+def test_pack_message_is_identical(generator):
+    for i in range(MESSAGES):
+        message = bytearray(generator.getrandbits(8) for i in range(codec.MESSAGE_SIZE))
+        expected = reference_process_outgoing_message(bytearray(message))
+
+        assert codec.pack_message(message) == expected
+
+
+def test_round_trip(generator):
+    for i in range(MESSAGES):
+        message = bytearray(generator.getrandbits(8) for i in range(codec.MESSAGE_SIZE))
+        payload = message[codec.PAYLOAD_START:codec.MARKERS_START]
+
+        codec.unpack_message(codec.pack_message(message))
+
+        assert message[codec.PAYLOAD_START:codec.MARKERS_START] == payload
+
+
+def test_unpack_message_overflow(generator):
+    for i in range(1000):
+        message = random_message(generator)
+
+        # Marked byte which already has the high bit
+        index = generator.randrange(codec.PAYLOAD_START, codec.MARKERS_START)
+        message[index] = message[index] | 0x80
+        message[index + codec.PAYLOAD_LENGTH] = 127
+
+        with pytest.raises(ValueError):
+            reference_process_ingoing_message(bytearray(message))
+        with pytest.raises(ValueError):
+            codec.unpack_message(message)
+
+
+def test_calculate_checksum_is_identical(generator):
+    for i in range(MESSAGES):
+        message = random_message(generator)
+
+        assert codec.calculate_checksum(message) == reference_calculate_checksum(message, codec.CHECKSUM_SIZE)
@@ -0,0 +1,145 @@
+# App to control the electric heater by Savitr with WiFi module.
+#
+# Tests of Home Assistant client against the stand-in of its REST API.
+#
+# Run: python -m pytest tests
+#
+# Version: 1.0.0.0
+# Author: antonwantstosleep, 2020.
+# License: MIT
+
+import asyncio
+import os
+import sys
+import time
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import savitr_hass as hass  # noqa: E402
+import savitr_transport as transport  # noqa: E402
+from savitr_simulator import FakeHomeAssistant  # noqa: E402
+
+# Max time to wait for writes, in seconds
+TIMEOUT = 5
+
+
+def run(coroutine):
+    """
+    Run coroutine on the shared loop of clients.
+    Returns: result of coroutine
+    """
+
+    return asyncio.run_coroutine_threadsafe(coroutine, transport.shared_loop()).result(TIMEOUT)
+
+
+def wait_for(predicate):
+    """
+    Wait till writer task of client makes predicate true.
+    Returns: True if it is true
+    """
+
+    deadline = time.monotonic() + TIMEOUT
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+
+    return True
+
+
+@pytest.fixture
+def fake():
+    server = FakeHomeAssistant()
+    run(server.start())
+    yield server
+    run(server.close())
+
+
+def test_states_are_written(fake):
+    client = hass.HassClient("http://127.0.0.1:{}".format(fake.port), fake.token)
+    try:
+        for i in range(10):
+            client.set_state("sensor.savitr_{}".format(i), state=i, attributes={"unit_of_measurement": "°C"})
+
+        assert wait_for(lambda: len(fake.states) == 10)
+        assert fake.states["sensor.savitr_3"] == {"entity_id": "sensor.savitr_3", "state": "3",
+                                                 "attributes": {"unit_of_measurement": "°C"}}
+        assert fake.connections == 1
+        assert client.errors == 0
+    finally:
+        client.task.cancel()
+
+
+def test_writes_are_pipelined():
+    requests = 20
+    received = []
+
+    async def handle(reader, writer):
+        # Read without answering till client stops writing, a client without pipelining waits for an answer
+        while True:
+            data = b''
+            try:
+                while True:
+                    chunk = await asyncio.wait_for(reader.read(65536), 0.2)
+                    if not chunk:
+                        return
+                    data = data + chunk
+            except asyncio.TimeoutError:
+                pass
+            if data:
+                received.append(data.count(b'POST '))
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}' * received[-1])
+                await writer.drain()
+
+    async def start():
+        return await asyncio.start_server(handle, '127.0.0.1', 0)
+
+    server = run(start())
+    client = hass.HassClient("http://127.0.0.1:{}".format(server.sockets[0].getsockname()[1]), 'test')
+    try:
+        for i in range(requests):
+            client.set_state("sensor.savitr_{}".format(i), state=i)
+
+        # The first write can be sent before the rest is queued, the rest goes in one pipeline
+        assert wait_for(lambda: client.requests == requests)
+        assert sum(received) == requests
+        assert max(received) >= requests // 2
+    finally:
+        client.task.cancel()
+        server.close()
+
+
+def test_writes_of_entity_are_coalesced():
+    fake = FakeHomeAssistant(lag=0.2)
+    run(fake.start())
+    client = hass.HassClient("http://127.0.0.1:{}".format(fake.port), fake.token)
+    try:
+        for i in range(10):
+            client.set_state("sensor.savitr_power", state=i)
+
+        # The first write can be sent before the rest is queued, the rest is coalesced into the latest one
+        assert wait_for(lambda: fake.states.get("sensor.savitr_power", {}).get("state") == "9")
+        time.sleep(0.5)
+        assert fake.requests <= 2
+        assert fake.states["sensor.savitr_power"]["state"] == "9"
+    finally:
+        client.task.cancel()
+        run(fake.close())
+
+
+def test_batch_is_sent_again_after_connection_close():
+    fake = FakeHomeAssistant(close_after=3)
+    run(fake.start())
+    client = hass.HassClient("http://127.0.0.1:{}".format(fake.port), fake.token)
+    try:
+        for i in range(10):
+            client.set_state("sensor.savitr_{}".format(i), state=i)
+
+        assert wait_for(lambda: len(fake.states) == 10)
+        assert all(fake.states["sensor.savitr_{}".format(i)]["state"] == str(i) for i in range(10))
+        assert fake.connections == 4
+        assert client.errors == 0
+    finally:
+        client.task.cancel()
+        run(fake.close())